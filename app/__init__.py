@@ -7,8 +7,11 @@ from flask_login import LoginManager
 from authlib.integrations.flask_client import OAuth
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
-from apscheduler.triggers.cron import CronTrigger
+from apscheduler.executors.pool import ThreadPoolExecutor
 from sqlalchemy import inspect
+from app.ssh_pool import ssh_pool
+from app.executor import host_executor
+from app.output_capture import output_store
 
 db = SQLAlchemy()
 migrate = Migrate()
@@ -21,8 +24,16 @@ oauth = OAuth()
 jobstores = {
     'default': SQLAlchemyJobStore(url=Config.SQLALCHEMY_DATABASE_URI)
 }
+# Global cap on concurrently running jobs; further due jobs wait for a free worker
+executors = {
+    'default': ThreadPoolExecutor(Config.SCHEDULER_MAX_CONCURRENT_JOBS)
+}
+job_defaults = {
+    'coalesce': Config.SCHEDULER_COALESCE,
+    'max_instances': Config.SCHEDULER_MAX_INSTANCES,
+}
 # Renamed 'scheduler' to 'bg_scheduler' to avoid name conflicts
-bg_scheduler = BackgroundScheduler(jobstores=jobstores, daemon=True)
+bg_scheduler = BackgroundScheduler(jobstores=jobstores, executors=executors, job_defaults=job_defaults, daemon=True)
 
 def get_distro_icon(distro):
     """Return appropriate icon for Linux distribution."""
@@ -60,6 +71,7 @@ def resync_scheduler_jobs(app):
     """
     with app.app_context():
         from app.models import ScheduledJob
+        from app.scheduler.tasks import schedule_job
         
         # Check if the table exists before querying to prevent errors on initial setup
         inspector = inspect(db.engine)
@@ -67,20 +79,15 @@ def resync_scheduler_jobs(app):
              print("INFO: 'scheduled_job' table not found, skipping scheduler sync. This is normal during initial db setup.")
              return
 
-        # Use the renamed scheduler object
-        bg_scheduler.remove_all_jobs()
+        # Only cron jobs (keyed by ScheduledJob ID) are replaced; one-off
+        # manual_run_* jobs queued by other processes are left to fire
+        for scheduled in bg_scheduler.get_jobs():
+            if scheduled.id.isdigit():
+                bg_scheduler.remove_job(scheduled.id)
         jobs = ScheduledJob.query.filter_by(is_enabled=True).all()
         for job in jobs:
             try:
-                # Use the renamed scheduler object and pass the task as a string
-                bg_scheduler.add_job(
-                    id=str(job.id),
-                    func='app.scheduler.tasks:pipeline_task', # Pass as string to avoid pickling issues
-                    args=[job.id],
-                    trigger=CronTrigger.from_crontab(job.cron_string),
-                    replace_existing=True,
-                    misfire_grace_time=3600 # Grace time of 1 hour for missed jobs
-                )
+                schedule_job(job)
             except Exception as e:
                 print(f"Error adding job {job.id} to scheduler: {e}")
 
@@ -95,14 +102,45 @@ def create_app(config_class=Config):
     migrate.init_app(app, db)
     login.init_app(app)
     oauth.init_app(app)
+    ssh_pool.init_app(app)
+    host_executor.init_app(app)
+    output_store.init_app(app)
+
+    from app.ai import ai_clients, response_cache
+    from app.host_resolver import host_resolver
+    ai_clients.init_app(app)
+    response_cache.init_app(app)
+    host_resolver.init_app(app)
+
+    from app.pipelines.alerts import alert_coalescer
+    from app.pipelines.history import run_history
+    from app.pipelines.plan import plan_cache
+    from app.pipelines.runner import pipeline_runner
+    pipeline_runner.init_app(app)
+    plan_cache.init_app(app)
+    run_history.init_app(app)
+    alert_coalescer.init_app(app)
+    app.before_request(pipeline_runner.recover)
+    app.before_request(alert_coalescer.recover)
 
     # Initialize and start the scheduler
     # Using with app.app_context() is best practice here
     with app.app_context():
         if not bg_scheduler.running:
-            bg_scheduler.start()
-            # Resync jobs from DB after scheduler starts
-            resync_scheduler_jobs(app)
+            # Scheduled jobs run inside this app rather than building their own
+            from app.scheduler.tasks import scheduler_worker, sync_next_run, NEXT_RUN_EVENTS
+            from app.scheduler.leader import scheduler_leader
+            scheduler_worker.init_app(app)
+            scheduler_leader.init_app(app)
+            bg_scheduler.add_listener(sync_next_run, NEXT_RUN_EVENTS)
+            # Start paused so every process can edit jobs in the shared job store;
+            # only the holder of the scheduler lease resumes it and fires jobs
+            # (and resyncs jobs from the DB when it takes over).
+            bg_scheduler.start(paused=True)
+            if app.config.get('SCHEDULER_MODE') == 'embedded':
+                # Only processes that serve requests compete for the lease; CLI
+                # commands such as `flask db upgrade` never fire jobs
+                app.before_request(scheduler_leader.start)
 
 
     # User loader function for Flask-Login
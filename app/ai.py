@@ -0,0 +1,493 @@
+"""
+Shared AI provider layer.
+
+Every AI call (script generation, dry runs, analyses, pipeline AI nodes)
+goes through the module-level ``ai_clients`` instead of configuring Gemini
+or building an OpenAI client per request. Clients are created once per
+provider and API key and kept, so their HTTP connections and TLS sessions
+are reused, and every call gets its provider's timeout
+(``AI_<PROVIDER>_TIMEOUT_SECONDS``, defaulting to ``AI_TIMEOUT_SECONDS``).
+
+Providers are picked by the names used in the UI and settings: ``gemini``,
+``chatgpt`` and ``local``. ``local`` talks to an OpenAI-compatible server
+at ``AI_LOCAL_BASE_URL`` (Ollama, llama.cpp, vLLM...), or, when none is
+configured, to an offline stand-in that answers instantly with a canned
+summary. ``AI_PROVIDER_OVERRIDE`` sends every call to one provider, e.g.
+``local`` in development and CI.
+
+Repeatable analyses (dry runs, script and output analysis) can go through
+``ai_clients.cached_complete``: responses are stored by a hash of provider,
+model and prompt in an in-memory LRU in front of the ``ai_response`` table,
+and expire after ``AI_CACHE_TTL_SECONDS``.
+
+Diagnostic outputs go through ``ai_clients.analyze``, which first compacts
+them (see app.compaction) and, when they are still too large for one prompt,
+splits them into chunks of ``AI_CHUNK_TOKENS``, summarizes up to
+``AI_CHUNK_CONCURRENCY`` chunks at a time and sends the combined summaries
+in place of the raw output. Token counts are estimates (about four
+characters per token), which is close enough for sizing chunks.
+"""
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import google.generativeai as genai
+import openai
+
+logger = logging.getLogger(__name__)
+
+
+class AIError(Exception):
+    """Raised when a provider is not configured or its API call fails."""
+
+
+class AIConfigError(AIError):
+    """Raised when a provider has no API key configured."""
+
+
+CHARS_PER_TOKEN = 4
+
+CHUNK_PROMPT = (
+    "You are helping analyze the output of a diagnostic script that is too large to read at once. "
+    "This is part {part} of {parts}. Summarize what matters in this part for troubleshooting: errors, "
+    "warnings, failures, anomalies and key figures, quoting the relevant lines. Be concise and do not "
+    "speculate about the other parts.\n\n---\n{chunk}\n---"
+)
+
+
+def estimate_tokens(text):
+    """Rough token count of a text, without a tokenizer."""
+    return -(-len(text or '') // CHARS_PER_TOKEN)
+
+
+def split_into_chunks(text, max_tokens):
+    """Splits text into pieces of at most ``max_tokens``, on line boundaries where possible."""
+    limit = max(1, max_tokens) * CHARS_PER_TOKEN
+    chunks, current, size = [], [], 0
+    for line in text.splitlines(keepends=True):
+        while len(line) > limit:
+            if current:
+                chunks.append(''.join(current))
+                current, size = [], 0
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if size + len(line) > limit:
+            chunks.append(''.join(current))
+            current, size = [], 0
+        current.append(line)
+        size += len(line)
+    if current:
+        chunks.append(''.join(current))
+    return chunks
+
+
+class AIProvider:
+    """A text-completion backend. Subclasses implement complete() and ping(), and stream() if they can."""
+
+    name = None
+    label = None
+
+    def __init__(self, model, timeout):
+        self.model = model
+        self.timeout = timeout
+
+    def complete(self, prompt, system=None):
+        raise NotImplementedError
+
+    def stream(self, prompt, system=None):
+        """Yields the response in pieces as the model generates it."""
+        yield self.complete(prompt, system=system)
+
+    def ping(self):
+        """Checks that the provider is reachable and the credentials work."""
+        raise NotImplementedError
+
+
+class OpenAIProvider(AIProvider):
+    name = 'chatgpt'
+    label = 'ChatGPT'
+
+    def __init__(self, api_key, model, timeout, max_retries=2, base_url=None):
+        super().__init__(model, timeout)
+        # One client per key: its HTTP connection pool is kept alive between calls
+        self.client = openai.OpenAI(api_key=api_key, base_url=base_url, timeout=timeout, max_retries=max_retries)
+
+    def _messages(self, prompt, system):
+        messages = [{"role": "system", "content": system}] if system else []
+        return messages + [{"role": "user", "content": prompt}]
+
+    def complete(self, prompt, system=None):
+        try:
+            response = self.client.chat.completions.create(model=self.model, messages=self._messages(prompt, system))
+        except openai.OpenAIError as e:
+            raise AIError(str(e)) from e
+        return response.choices[0].message.content
+
+    def stream(self, prompt, system=None):
+        try:
+            response = self.client.chat.completions.create(model=self.model, messages=self._messages(prompt, system), stream=True)
+        except openai.OpenAIError as e:
+            raise AIError(str(e)) from e
+        try:
+            for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        except openai.OpenAIError as e:
+            raise AIError(str(e)) from e
+        finally:
+            response.close()
+
+    def ping(self):
+        try:
+            self.client.models.list()
+        except openai.OpenAIError as e:
+            raise AIError(str(e)) from e
+
+
+class GeminiProvider(AIProvider):
+    name = 'gemini'
+    label = 'Gemini'
+
+    # genai keeps one process-wide API key. Calls hold it for their own key:
+    # calls with the same key run side by side, and switching to another key
+    # waits until no call is using the current one.
+    _configured_key = None
+    _active_calls = 0
+    _key_changed = threading.Condition()
+
+    def __init__(self, api_key, model, timeout):
+        super().__init__(model, timeout)
+        self.api_key = api_key
+        self._models = {}
+
+    @contextmanager
+    def _configured(self):
+        cls = GeminiProvider
+        with cls._key_changed:
+            while cls._configured_key != self.api_key and cls._active_calls:
+                cls._key_changed.wait()
+            if cls._configured_key != self.api_key:
+                genai.configure(api_key=self.api_key)
+                cls._configured_key = self.api_key
+            cls._active_calls += 1
+        try:
+            yield
+        finally:
+            with cls._key_changed:
+                cls._active_calls -= 1
+                cls._key_changed.notify_all()
+
+    def _model(self, system):
+        if system not in self._models:
+            self._models[system] = genai.GenerativeModel(self.model, system_instruction=system)
+        return self._models[system]
+
+    def complete(self, prompt, system=None):
+        try:
+            with self._configured():
+                response = self._model(system).generate_content(prompt, request_options={'timeout': self.timeout})
+                return response.text
+        except Exception as e:
+            raise AIError(str(e)) from e
+
+    def stream(self, prompt, system=None):
+        try:
+            with self._configured():
+                for chunk in self._model(system).generate_content(prompt, stream=True, request_options={'timeout': self.timeout}):
+                    if chunk.parts:
+                        yield chunk.text
+        except Exception as e:
+            raise AIError(str(e)) from e
+
+    def ping(self):
+        try:
+            with self._configured():
+                next(iter(genai.list_models(request_options={'timeout': self.timeout})), None)
+        except Exception as e:
+            raise AIError(str(e)) from e
+
+
+class StandInProvider(AIProvider):
+    """Offline stand-in for development and tests: answers at once without calling any API."""
+
+    name = 'local'
+    label = 'Local'
+
+    def complete(self, prompt, system=None):
+        lines = [line for line in prompt.splitlines() if line.strip()]
+        preview = '\n'.join(lines[:5])
+        return (f"HEADING: Local Analysis\nThis response came from the offline stand-in provider "
+                f"({len(prompt)} characters, {len(lines)} non-empty lines received).\n\n{preview}")
+
+    def stream(self, prompt, system=None):
+        for word in self.complete(prompt, system).split(' '):
+            yield word + ' '
+
+    def ping(self):
+        pass
+
+
+class ResponseCache:
+    """
+    Two-tier cache of AI responses: an in-process LRU backed by the
+    ai_response table. The table is read and written on connections of its
+    own, so a cache write never commits (or a failed read rolls back) the
+    caller's session.
+    """
+
+    # Expired rows and rows beyond max_rows are evicted at most this often
+    EVICT_INTERVAL_SECONDS = 300
+
+    def __init__(self, memory_size=256, ttl_seconds=86400, max_rows=5000):
+        self.memory_size = memory_size
+        self.ttl_seconds = ttl_seconds
+        self.max_rows = max_rows
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_evicted = 0
+
+    def init_app(self, app):
+        self.memory_size = app.config.get('AI_CACHE_MEMORY_SIZE', self.memory_size)
+        self.ttl_seconds = app.config.get('AI_CACHE_TTL_SECONDS', self.ttl_seconds)
+        self.max_rows = app.config.get('AI_CACHE_MAX_ROWS', self.max_rows)
+        with self._lock:
+            self._memory.clear()
+
+    @staticmethod
+    def key(provider, model, system, prompt):
+        digest = hashlib.sha256()
+        for part in (provider, model, system or '', prompt):
+            digest.update(part.encode('utf-8'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def get(self, key):
+        """The cached response for a key, or None. Must be called inside an app context."""
+        if not self.ttl_seconds:
+            return None
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if time.time() - entry[0] < self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    return entry[1]
+                del self._memory[key]
+
+        from app import db
+        from app.models import AIResponse
+        table = AIResponse.__table__
+        try:
+            with db.engine.connect() as conn:
+                row = conn.execute(db.select(table.c.response, table.c.created_at).where(table.c.key == key)).first()
+        except Exception as e:
+            logger.error(f"Could not read the AI response cache: {e}")
+            return None
+        if row is None:
+            return None
+        age = (datetime.utcnow() - row.created_at).total_seconds()
+        if age >= self.ttl_seconds:
+            return None
+        self._remember(key, row.response, time.time() - age)
+        return row.response
+
+    def put(self, key, provider, model, response):
+        """Stores a response; expired rows and the oldest beyond AI_CACHE_MAX_ROWS are evicted periodically."""
+        if not self.ttl_seconds:
+            return
+        self._remember(key, response, time.time())
+
+        from app import db
+        from app.models import AIResponse
+        table = AIResponse.__table__
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(table.delete().where(table.c.key == key))
+                conn.execute(table.insert().values(key=key, provider=provider, model=model, response=response,
+                                                   created_at=datetime.utcnow()))
+        except Exception as e:
+            logger.error(f"Could not write the AI response cache: {e}")
+            return
+
+        with self._lock:
+            due = time.monotonic() - self._last_evicted >= self.EVICT_INTERVAL_SECONDS
+            if due:
+                self._last_evicted = time.monotonic()
+        if due:
+            self._evict()
+
+    def _evict(self):
+        from app import db
+        from app.models import AIResponse
+        table = AIResponse.__table__
+        cutoff = datetime.utcnow() - timedelta(seconds=self.ttl_seconds)
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(table.delete().where(table.c.created_at < cutoff))
+                excess = conn.execute(db.select(db.func.count()).select_from(table)).scalar() - self.max_rows
+                if excess > 0:
+                    oldest = db.select(table.c.key).order_by(table.c.created_at).limit(excess).scalar_subquery()
+                    conn.execute(table.delete().where(table.c.key.in_(oldest)))
+        except Exception as e:
+            logger.error(f"Could not evict from the AI response cache: {e}")
+
+    def _remember(self, key, response, stored_at):
+        with self._lock:
+            self._memory[key] = (stored_at, response)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+
+class AIClients:
+    """Creates and caches one provider client per (provider, API key)."""
+
+    def __init__(self):
+        self.config = {}
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.config = app.config
+        with self._lock:
+            self._clients.clear()
+
+    def _setting(self, key, default=None):
+        return self.config.get(key, default)
+
+    def provider(self, name=None, app_config=None, api_key=None, override=True):
+        """
+        Returns the client for a provider name ('gemini', 'chatgpt' or 'local';
+        unknown names fall back to 'chatgpt' as before). ``app_config`` is the
+        settings dict holding '<provider>_api_key' (loaded from the Setting
+        table when omitted); ``api_key`` overrides it. ``override=False``
+        ignores AI_PROVIDER_OVERRIDE, to reach the named provider itself.
+        Raises AIConfigError when the provider has no API key.
+        """
+        if app_config is None and api_key is None:
+            from app.models import Setting
+            app_config = {s.key: s.value for s in Setting.query.all()}
+        app_config = app_config or {}
+        name = (override and self._setting('AI_PROVIDER_OVERRIDE')) or name or app_config.get('ai_provider') or 'gemini'
+        if name not in ('gemini', 'local'):
+            name = 'chatgpt'
+
+        base_url = self._setting('AI_LOCAL_BASE_URL') if name == 'local' else None
+        if name != 'local' or base_url:
+            api_key = api_key or app_config.get(f'{name}_api_key') or ('local' if base_url else None)
+            if not api_key:
+                label = 'Gemini' if name == 'gemini' else 'ChatGPT'
+                raise AIConfigError(f"{label} API key not set in Settings.")
+
+        key = (name, api_key, base_url)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = self._clients[key] = self._create(name, api_key, base_url)
+            return client
+
+    def _timeout(self, name):
+        setting = {'gemini': 'AI_GEMINI_TIMEOUT_SECONDS', 'chatgpt': 'AI_OPENAI_TIMEOUT_SECONDS', 'local': 'AI_LOCAL_TIMEOUT_SECONDS'}[name]
+        return self._setting(setting) or self._setting('AI_TIMEOUT_SECONDS', 60)
+
+    def _create(self, name, api_key, base_url):
+        timeout = self._timeout(name)
+        if name == 'gemini':
+            return GeminiProvider(api_key, self._setting('AI_GEMINI_MODEL', 'gemini-1.5-flash'), timeout)
+        if name == 'local' and not base_url:
+            return StandInProvider('stand-in', timeout)
+        if name == 'local':
+            return OpenAIProvider(api_key, self._setting('AI_LOCAL_MODEL', 'llama3'), timeout,
+                                  self._setting('AI_MAX_RETRIES', 2), base_url=base_url)
+        return OpenAIProvider(api_key, self._setting('AI_OPENAI_MODEL', 'gpt-3.5-turbo'), timeout,
+                              self._setting('AI_MAX_RETRIES', 2))
+
+    def complete(self, prompt, provider=None, app_config=None, system=None, api_key=None):
+        """Sends one prompt to a provider and returns the response text. Raises AIError on failure."""
+        return self.provider(provider, app_config, api_key).complete(prompt, system=system)
+
+    def analyze(self, build_prompt, data, provider=None, app_config=None, system=None, api_key=None):
+        """
+        Analyzes diagnostic ``data`` with the prompt ``build_prompt(data)``.
+        The data is compacted first, unless AI_COMPACT_ENABLED is off. Data
+        still over ``AI_CHUNK_TOKENS`` is map-reduced: its chunks are
+        summarized concurrently (repeatedly, while the summaries are still too
+        large) and the final prompt is built from the summaries instead.
+        Returns a dict with the analysis 'output', the number of 'chunks', the
+        estimated 'tokens_sent' across all calls and the data's estimated
+        'tokens_before' and 'tokens_after' compaction. Raises AIError on failure.
+        """
+        client = self.provider(provider, app_config, api_key)
+        tokens_before = tokens_after = estimate_tokens(data)
+        if self._setting('AI_COMPACT_ENABLED', True):
+            from app.compaction import compact
+            data, (tokens_before, tokens_after) = compact(data, self._setting('AI_COMPACT_SECTION_LINES', 100),
+                                                          self._setting('AI_COMPACT_TOKEN_BUDGET', 0))
+        chunk_tokens = self._setting('AI_CHUNK_TOKENS', 6000)
+        sent = 0
+        chunks = 0
+        while estimate_tokens(data) > chunk_tokens:
+            parts = split_into_chunks(data, chunk_tokens)
+            prompts = [CHUNK_PROMPT.format(part=i, parts=len(parts), chunk=chunk) for i, chunk in enumerate(parts, 1)]
+            with ThreadPoolExecutor(max_workers=max(1, self._setting('AI_CHUNK_CONCURRENCY', 4))) as pool:
+                summaries = list(pool.map(lambda p: client.complete(p, system=system), prompts))
+            sent += sum(estimate_tokens(p) + estimate_tokens(system) for p in prompts)
+            chunks = chunks or len(parts)
+            reduced = (f"The data was too large to send at once, so it was summarized in {len(parts)} consecutive parts:\n\n"
+                       + '\n\n'.join(f"Part {i}:\n{summary.strip()}" for i, summary in enumerate(summaries, 1)))
+            # Summaries that don't shrink the data won't converge; send them as they are
+            shrunk = len(reduced) < len(data)
+            data = reduced
+            if not shrunk:
+                break
+
+        prompt = build_prompt(data)
+        output = client.complete(prompt, system=system)
+        sent += estimate_tokens(prompt) + estimate_tokens(system)
+        return {'output': output, 'chunks': chunks, 'tokens_sent': sent,
+                'tokens_before': tokens_before, 'tokens_after': tokens_after}
+
+    def cached_complete(self, prompt, provider=None, app_config=None, system=None, refresh=False):
+        """
+        Same as complete(), answered from the response cache when the same
+        provider and model have already seen this prompt. ``refresh`` skips the
+        lookup (the new response is still stored). Returns (text, cached).
+        """
+        client = self.provider(provider, app_config)
+        key = response_cache.key(client.name, client.model, system, prompt)
+        if not refresh:
+            cached = response_cache.get(key)
+            if cached is not None:
+                return cached, True
+        text = client.complete(prompt, system=system)
+        response_cache.put(key, client.name, client.model, text)
+        return text, False
+
+    def stream(self, prompt, provider=None, app_config=None, system=None, cache=False, refresh=False):
+        """
+        Yields the response in pieces as the provider generates them. With
+        ``cache`` a cached response is yielded whole and a completed stream is
+        stored, as in cached_complete(). Raises AIError on failure.
+        """
+        client = self.provider(provider, app_config)
+        if not cache:
+            yield from client.stream(prompt, system=system)
+            return
+        key = response_cache.key(client.name, client.model, system, prompt)
+        cached = None if refresh else response_cache.get(key)
+        if cached is not None:
+            yield cached
+            return
+        pieces = []
+        for piece in client.stream(prompt, system=system):
+            pieces.append(piece)
+            yield piece
+        response_cache.put(key, client.name, client.model, ''.join(pieces))
+
+
+response_cache = ResponseCache()
+ai_clients = AIClients()
@@ -3,6 +3,8 @@ from functools import wraps
 from . import bp
 from app.models import User, Host, Script, Pipeline
 from app import db
+from app.host_resolver import host_resolver
+from app.pipelines.plan import plan_cache
 
 def require_api_key(f):
     """Decorator to protect routes with API key authentication."""
@@ -41,6 +43,8 @@ def create_host():
     new_host = Host(**data)
     db.session.add(new_host)
     db.session.commit()
+    plan_cache.invalidate()
+    host_resolver.invalidate()
     return jsonify({'message': 'Host created successfully', 'id': new_host.id}), 201
 
 # --- Placeholder Endpoints ---
@@ -1,13 +1,22 @@
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, request, jsonify, current_app, url_for
 from functools import wraps
 import json
 # Import all necessary models and utility functions
-from app.models import User, Host, Pipeline, Script, Setting 
-from app.utils import get_ai_analysis, execute_ssh_command, send_to_discord
+from app.host_resolver import host_resolver
+from app.models import User, Pipeline, PipelineRun, Setting 
+from app.pipelines.alerts import alert_coalescer
+from app.pipelines.plan import PipelineCycleError
+from app.pipelines.runner import RunQueueFull
 
 # Create a new Blueprint for the Zabbix API endpoint
 zabbix_bp = Blueprint('zabbix_api', __name__)
 
+OUTCOME_MESSAGES = {
+    'queued': 'Pipeline queued.',
+    'coalesced': 'Alert merged into a pending run for the same trigger on other hosts.',
+    'deduplicated': 'Duplicate alert; a run for this host, pipeline and trigger already exists.',
+}
+
 # --- API Key Authentication Decorator ---
 def require_api_key(f):
     @wraps(f)
@@ -23,13 +32,40 @@ def require_api_key(f):
     return decorated_function
 
 
+def _alert_options(host, trigger_name, ai_provider):
+    # --- Shared Pipeline Execution Engine ---
+    # Every script runs on the alerting host, and the AI prompt and Discord
+    # report carry the trigger details. The pipeline stops at the first failing script.
+    return {
+        'host_id': host.id,
+        'ai_provider': ai_provider,
+        'stop_on_script_failure': True,
+        'trigger': {'hostname': host.name, 'trigger_name': trigger_name},
+    }
+
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _has_nodes(pipeline):
+    """Raises json.JSONDecodeError if the definition is not valid JSON."""
+    pipeline_data = json.loads(pipeline.definition) if pipeline.definition else {}
+    return isinstance(pipeline_data, dict) and 'nodes' in pipeline_data
+
+
 # --- The Zabbix Webhook Endpoint ---
 @zabbix_bp.route('/trigger', methods=['POST'])
 @require_api_key
 def trigger_from_zabbix():
     """
     Receives an alert from Zabbix, finds the corresponding host and pipeline,
-    executes all steps in the pipeline, and sends notifications.
+    and queues the pipeline on that host through the shared pipeline engine.
+    Returns the run ID straight away so the webhook does not time out; poll
+    the status URL for the outcome.
     """
     data = request.get_json()
     if not data:
@@ -42,7 +78,7 @@ def trigger_from_zabbix():
     if not hostname_from_zabbix or not pipeline_id:
         return jsonify({'error': 'Payload must contain "hostname" and "pipeline_id"'}), 400
 
-    host = Host.query.filter_by(name=hostname_from_zabbix).first()
+    host = host_resolver.resolve(hostname_from_zabbix)
     if not host:
         current_app.logger.error(f"Pipeline trigger failed: Host '{hostname_from_zabbix}' not found.")
         return jsonify({'error': f'Host "{hostname_from_zabbix}" not found'}), 404
@@ -52,82 +88,116 @@ def trigger_from_zabbix():
         current_app.logger.error(f"Pipeline trigger failed: Pipeline ID '{pipeline_id}' not found.")
         return jsonify({'error': f'Pipeline ID "{pipeline_id}" not found'}), 404
 
-    current_app.logger.info(f"Executing Pipeline '{pipeline.name}' on Host '{host.name}' from Zabbix trigger '{trigger_name}'.")
+    current_app.logger.info(f"Queueing Pipeline '{pipeline.name}' on Host '{host.name}' from Zabbix trigger '{trigger_name}'.")
 
-    # --- Full Pipeline Execution Engine ---
-    
-    # Context dictionary to hold results from each step
-    pipeline_context = {
-        "script_outputs": [],
-        "ai_analysis": "",
-        "errors": []
-    }
+    ai_setting = Setting.query.filter_by(key='ai_provider').first()
+    options = _alert_options(host, trigger_name, data.get('ai_provider') or (ai_setting.value if ai_setting else 'chatgpt'))
 
     try:
-        pipeline_data = json.loads(pipeline.definition) if pipeline.definition else {}
-        if not (isinstance(pipeline_data, dict) and 'nodes' in pipeline_data):
+        if not _has_nodes(pipeline):
             current_app.logger.warning(f"Pipeline {pipeline.id} has an unrecognized definition format.")
             return jsonify({'status': 'success', 'message': 'Pipeline triggered but had no valid nodes to execute.'}), 202
-
-        # --- Fetch API keys and webhook URL once at the start ---
-        chatgpt_setting = Setting.query.filter_by(key='chatgpt_api_key').first()
-        discord_setting = Setting.query.filter_by(key='discord_webhook').first()
-        chatgpt_api_key = chatgpt_setting.value if chatgpt_setting else None
-        discord_webhook_url = discord_setting.value if discord_setting else None
-
-        # Iterate through all nodes defined in the pipeline
-        for node in pipeline_data.get('nodes', {}).values():
-            if not isinstance(node, dict):
-                continue
-            
-            node_name = node.get('name')
-            node_type = node.get('type')
-
-            # --- Step 1: Execute Script Node ---
-            if node_type == 'script' and node.get('content'):
-                script_name = node.get('name', 'Untitled Script')
-                script_content = node.get('content')
-                current_app.logger.info(f"Executing script node: '{script_name}'")
-                output, error = execute_ssh_command(host, script_content)
-                pipeline_context["script_outputs"].append(f"--- Output of '{script_name}' ---\n{output}")
-                if error:
-                    pipeline_context["errors"].append(f"--- Error from '{script_name}' ---\n{error}")
-                    break # Stop pipeline on error
-
-            # --- Step 2: AI Analysis Node ---
-            elif node_name == 'AI Analysis':
-                current_app.logger.info("Executing action node: 'AI Analysis'")
-                full_diagnostic_data = "\n".join(pipeline_context["script_outputs"])
-                prompt_context = f"A Zabbix alert named '{trigger_name}' occurred on host '{host.name}'. The following diagnostic data was collected."
-                ai_result = get_ai_analysis(full_diagnostic_data, prompt_context, api_key=chatgpt_api_key)
-                pipeline_context["ai_analysis"] = ai_result
-
-            # --- Step 3: Notify Discord Node ---
-            elif node_name == 'Notify Discord':
-                current_app.logger.info("Executing action node: 'Notify Discord'")
-                
-                # Construct the full, untruncated message
-                message = (
-                    f"**Zabbix Alert Triage Report**\n"
-                    f"**Host:** `{host.name}`\n"
-                    f"**Trigger:** `{trigger_name}`\n"
-                    f"**Pipeline:** `{pipeline.name}`\n"
-                    f"----------------------------------------\n"
-                    f"**AI Synopsis & Recommendations:**\n"
-                    f"```\n{pipeline_context.get('ai_analysis', 'N/A')}\n```\n"
-                    f"----------------------------------------\n"
-                    f"**Raw Diagnostic Output:**\n"
-                    f"```\n{''.join(pipeline_context.get('script_outputs', ['No output.']))}\n```"
-                )
-                
-                # Pass the full message to the smart send_to_discord function
-                send_to_discord(discord_webhook_url, message)
-
+        # Alerts are queued at high priority, ahead of manual and scheduled runs;
+        # repeats and concurrent alerts from other hosts join an existing run
+        run, outcome = alert_coalescer.submit(pipeline, host, trigger_name, options)
     except json.JSONDecodeError:
         current_app.logger.error(f"Could not execute pipeline {pipeline.id}: Invalid JSON in definition.")
         return jsonify({'error': 'Pipeline definition is not valid JSON.'}), 500
+    except PipelineCycleError as e:
+        return jsonify({'error': str(e)}), 400
+    except RunQueueFull as e:
+        current_app.logger.error(f"Pipeline trigger rejected: {e}")
+        return jsonify({'error': str(e)}), 429
     except Exception as e:
-        current_app.logger.error(f"An unexpected error occurred during pipeline execution: {e}")
-        return jsonify({'error': 'An unexpected error occurred during pipeline execution.'}), 500
+        current_app.logger.error(f"An unexpected error occurred while queueing the pipeline: {e}")
+        return jsonify({'error': 'An unexpected error occurred while queueing the pipeline.'}), 500
+
+    return jsonify({
+        'status': 'success',
+        'message': OUTCOME_MESSAGES[outcome],
+        'outcome': outcome,
+        'run_id': run.id,
+        'run_status': run.status,
+        'status_url': url_for('zabbix_api.run_status', run_id=run.id),
+    }), 202
+
 
-    return jsonify({'status': 'success', 'message': 'Pipeline executed successfully.'}), 202
+@zabbix_bp.route('/trigger/batch', methods=['POST'])
+@require_api_key
+def trigger_batch_from_zabbix():
+    """
+    Receives several alerts at once, as {"alerts": [...]} or a bare list of
+    single-trigger payloads. Hosts and pipelines are resolved with one query
+    each and every new run is created in one transaction; alerts for the same
+    pipeline and trigger share one matrix run. Returns a result per alert, in
+    order, with either a run ID or an error.
+    """
+    data = request.get_json()
+    alerts = data.get('alerts') if isinstance(data, dict) else data
+    if not isinstance(alerts, list) or not alerts:
+        return jsonify({'error': 'Payload must be a non-empty list of alerts or {"alerts": [...]}'}), 400
+    max_size = current_app.config.get('ALERT_BATCH_MAX_SIZE', 500)
+    if len(alerts) > max_size:
+        return jsonify({'error': f'A batch may contain at most {max_size} alerts.'}), 413
+
+    alerts = [a if isinstance(a, dict) else {} for a in alerts]
+    pipeline_ids = [_int_or_none(a.get('pipeline_id')) for a in alerts]
+    names = {a.get('hostname') for a in alerts if a.get('hostname')}
+    hosts = host_resolver.resolve_many(names)
+    wanted = {pid for pid in pipeline_ids if pid is not None}
+    pipelines = {p.id: p for p in Pipeline.query.filter(Pipeline.id.in_(wanted)).all()} if wanted else {}
+    ai_setting = Setting.query.filter_by(key='ai_provider').first()
+    default_provider = ai_setting.value if ai_setting else 'chatgpt'
+
+    results = [None] * len(alerts)
+    accepted, positions = [], []
+    for i, (alert, pipeline_id) in enumerate(zip(alerts, pipeline_ids)):
+        hostname, trigger_name = alert.get('hostname'), alert.get('trigger_name', 'N/A')
+        pipeline = pipelines.get(pipeline_id)
+        if not hostname or not alert.get('pipeline_id'):
+            error = 'Alert must contain "hostname" and "pipeline_id"'
+        elif hostname not in hosts:
+            error = f'Host "{hostname}" not found'
+        elif pipeline is None:
+            error = f'Pipeline ID "{alert.get("pipeline_id")}" not found'
+        else:
+            try:
+                error = None if _has_nodes(pipeline) else 'Pipeline has no valid nodes to execute.'
+            except json.JSONDecodeError:
+                error = 'Pipeline definition is not valid JSON.'
+        if error:
+            results[i] = {'index': i, 'error': error}
+            continue
+        host = hosts[hostname]
+        accepted.append((pipeline, host, trigger_name, _alert_options(host, trigger_name, alert.get('ai_provider') or default_provider)))
+        positions.append(i)
+
+    if accepted:
+        current_app.logger.info(f"Queueing {len(accepted)} of {len(alerts)} batched Zabbix alerts.")
+        try:
+            submitted = alert_coalescer.submit_many(accepted)
+        except Exception as e:
+            current_app.logger.error(f"An unexpected error occurred while queueing the batch: {e}")
+            return jsonify({'error': 'An unexpected error occurred while queueing the batch.'}), 500
+        for i, (run, outcome, error) in zip(positions, submitted):
+            results[i] = {'index': i, 'outcome': outcome}
+            if run is not None:
+                results[i].update(run_id=run.id, status_url=url_for('zabbix_api.run_status', run_id=run.id))
+            if error:
+                results[i]['error'] = error
+
+    return jsonify({
+        'accepted': sum(1 for r in results if 'error' not in r),
+        'failed': sum(1 for r in results if 'error' in r),
+        'results': results,
+    }), 202
+
+
+@zabbix_bp.route('/runs/<int:run_id>', methods=['GET'])
+@require_api_key
+def run_status(run_id):
+    """Returns the status, per-step results and timings of a pipeline run, for webhook callers."""
+    run = PipelineRun.query.get(run_id)
+    if not run:
+        return jsonify({'error': f'Run "{run_id}" not found'}), 404
+    return jsonify(run.to_dict())
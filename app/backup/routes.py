@@ -9,6 +9,8 @@ from werkzeug.utils import secure_filename
 from . import bp
 from app.models import Host, Script, Pipeline, Setting
 from app import db
+from app.host_resolver import host_resolver
+from app.pipelines.plan import plan_cache
 from app.utils import push_to_github
 
 @bp.route('/')
@@ -33,7 +35,7 @@ def create_backup():
 
         # Backup data
         hosts = Host.query.all()
-        hosts_data = [{'id': h.id, 'name': h.name, 'ip_address': h.ip_address, 'ssh_user': h.ssh_user, 'os_type': h.os_type, 'distro': h.distro, 'location': h.location, 'description': h.description} for h in hosts]
+        hosts_data = [{'id': h.id, 'name': h.name, 'ip_address': h.ip_address, 'ssh_user': h.ssh_user, 'os_type': h.os_type, 'distro': h.distro, 'location': h.location, 'description': h.description, 'aliases': h.aliases} for h in hosts]
         with open(os.path.join(backup_dir, 'hosts.json'), 'w') as f:
             json.dump(hosts_data, f, indent=4)
 
@@ -210,6 +212,8 @@ def execute_restore():
                     s_data.pop('id', None); db.session.add(Setting(**s_data))
 
         db.session.commit()
+        plan_cache.invalidate()
+        host_resolver.invalidate()
         flash(f'Successfully restored: {", ".join(restore_items)}', 'success')
 
     except Exception as e:
@@ -1,7 +1,9 @@
 import click
 import getpass
+import time
+from datetime import datetime
 from app import db
-from app.models import User, Group
+from app.models import User, Group, SchedulerLease
 
 def register_cli_commands(app):
     """Register custom CLI commands with the Flask app."""
@@ -121,3 +123,32 @@ def register_cli_commands(app):
                     click.echo(f"Group '{group_name}' already exists.")
             db.session.commit()
             click.echo("Default groups setup complete.")
+
+    @app.cli.group()
+    def scheduler():
+        """Cron scheduler commands."""
+        pass
+
+    @scheduler.command('run')
+    def run_scheduler():
+        """Runs a dedicated scheduler process that fires jobs while it holds the scheduler lease."""
+        from app.scheduler.leader import scheduler_leader
+        click.echo(f"Scheduler {scheduler_leader.holder} started; waiting for the lease...")
+        scheduler_leader.start()
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            scheduler_leader.stop()
+            click.echo("Scheduler stopped.")
+
+    @scheduler.command('status')
+    def scheduler_status():
+        """Shows which process currently holds the scheduler lease."""
+        lease = SchedulerLease.query.get('scheduler')
+        if lease is None:
+            click.echo("No process has held the scheduler lease yet.")
+        elif lease.expires_at < datetime.utcnow():
+            click.echo(f"Lease is free (last held by {lease.holder}, expired {lease.expires_at} UTC).")
+        else:
+            click.echo(f"Lease held by {lease.holder} until {lease.expires_at} UTC.")
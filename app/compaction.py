@@ -0,0 +1,99 @@
+"""
+Compaction of diagnostic output before it is sent to an AI provider.
+
+Script output collected for analysis is padded with terminal noise: colour
+and cursor escape codes, progress bars redrawn with carriage returns, the
+same log line repeated hundreds of times, runs of blank lines and process
+tables thousands of rows long. None of it helps the analysis, and all of it
+costs tokens and latency. ``compact`` removes it:
+
+* ANSI/VT escape sequences and other control characters are stripped, and
+  only the final state of lines redrawn with carriage returns is kept;
+* consecutive repeats of a line become one line with a repeat count, and
+  runs of blank lines become one;
+* sections (blocks between blank lines) longer than ``section_lines`` keep
+  their head and tail;
+* if the result is still over ``token_budget``, its head and tail are kept.
+"""
+import re
+
+from app.ai import estimate_tokens, CHARS_PER_TOKEN
+
+# CSI (colours, cursor movement), OSC (window titles, hyperlinks) and two-character escapes
+_ESCAPES = re.compile(r'\x1b\[[0-?]*[ -/]*[@-~]|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)|\x1b[@-Z\\-_]')
+_CONTROL = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]')
+
+
+def _apply_backspaces(line):
+    chars = []
+    for char in line:
+        if char != '\b':
+            chars.append(char)
+        elif chars:
+            chars.pop()
+    return ''.join(chars)
+
+
+def strip_control(text):
+    """Removes escape sequences and control characters, keeping what a terminal would finally show per line."""
+    text = _ESCAPES.sub('', text.replace('\r\n', '\n'))
+    lines = []
+    for line in text.split('\n'):
+        if '\r' in line:
+            line = line.rstrip('\r').rsplit('\r', 1)[-1]
+        if '\b' in line:
+            line = _apply_backspaces(line)
+        lines.append(_CONTROL.sub('', line).rstrip())
+    return lines
+
+
+def collapse_repeats(lines):
+    """Collapses consecutive identical lines into one with a count, and blank runs into one blank line."""
+    collapsed = []
+    i = 0
+    while i < len(lines):
+        j = i
+        while j + 1 < len(lines) and lines[j + 1] == lines[i]:
+            j += 1
+        count = j - i + 1
+        collapsed.append(lines[i] if count == 1 or not lines[i] else f"{lines[i]}  [repeated {count} times]")
+        i = j + 1
+    return collapsed
+
+
+def trim_sections(lines, section_lines):
+    """Keeps the head and tail of every blank-line-separated section longer than ``section_lines``."""
+    if not section_lines:
+        return lines
+    head = section_lines // 2
+    tail = section_lines - head
+    trimmed, section = [], []
+    for line in lines + ['']:
+        if line:
+            section.append(line)
+            continue
+        if len(section) > section_lines:
+            section = section[:head] + [f"[... {len(section) - head - tail} lines omitted ...]"] + section[-tail:]
+        trimmed.extend(section)
+        trimmed.append(line)
+        section = []
+    return trimmed[:-1]
+
+
+def fit_budget(text, token_budget):
+    """Keeps the head and tail of a text over ``token_budget``, cutting on line boundaries."""
+    if not token_budget or estimate_tokens(text) <= token_budget:
+        return text
+    keep = token_budget * CHARS_PER_TOKEN // 2
+    head = text[:keep].rsplit('\n', 1)[0]
+    tail = text[-keep:].split('\n', 1)[-1]
+    omitted = text.count('\n') - head.count('\n') - tail.count('\n')
+    return f"{head}\n[... {omitted} lines omitted to fit the token budget ...]\n{tail}"
+
+
+def compact(text, section_lines=100, token_budget=0):
+    """Returns the compacted text and its (before, after) estimated token counts."""
+    text = text or ''
+    lines = trim_sections(collapse_repeats(strip_control(text)), section_lines)
+    compacted = fit_budget('\n'.join(lines).strip('\n'), token_budget)
+    return compacted, (estimate_tokens(text), estimate_tokens(compacted))
@@ -0,0 +1,189 @@
+"""
+Bounded-concurrency fan-out of commands across many hosts.
+
+A single process-wide thread pool caps the total number of concurrent SSH
+commands, and each request can further limit how many of its own hosts run
+at once. Results always come back in the order the hosts were given.
+
+Streamed commands run on a separate, smaller pool: their workers live as
+long as the browser reading them, and must not hold up pipeline steps.
+"""
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from app.ssh_pool import ssh_pool, target_for_host
+
+logger = logging.getLogger(__name__)
+
+
+class HostExecutor:
+    """Runs one command on many hosts through a shared, bounded worker pool."""
+
+    def __init__(self, max_workers=32, max_workers_per_request=16, stream_max_workers=8):
+        self.max_workers = max_workers
+        self.max_workers_per_request = max_workers_per_request
+        self.stream_max_workers = stream_max_workers
+        self._pool = None
+        self._stream_pool = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Reads the global, per-request and streaming worker limits from the app config."""
+        self.max_workers = app.config.get('EXECUTOR_MAX_WORKERS', self.max_workers)
+        self.max_workers_per_request = app.config.get('EXECUTOR_MAX_WORKERS_PER_REQUEST', self.max_workers_per_request)
+        self.stream_max_workers = app.config.get('EXECUTOR_STREAM_MAX_WORKERS', self.stream_max_workers)
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='host-exec')
+            return self._pool
+
+    @property
+    def stream_pool(self):
+        with self._lock:
+            if self._stream_pool is None:
+                self._stream_pool = ThreadPoolExecutor(max_workers=self.stream_max_workers, thread_name_prefix='host-stream')
+            return self._stream_pool
+
+    def submit(self, fn, *args, **kwargs):
+        """Submits an arbitrary callable to the shared worker pool."""
+        return self.pool.submit(fn, *args, **kwargs)
+
+    def worker_limit(self, requested=None):
+        """Clamps a requested per-request concurrency to the configured limits."""
+        limit = min(self.max_workers_per_request, self.max_workers)
+        if requested:
+            try:
+                limit = min(limit, max(1, int(requested)))
+            except (TypeError, ValueError):
+                pass
+        return limit
+
+    @staticmethod
+    def _run_one(host_id, host_name, target, command):
+        started = time.perf_counter()
+        output_url = error_url = None
+        try:
+            stdout, stderr, exit_code = ssh_pool.exec_command(target, command)
+            output, error, success = str(stdout), str(stderr), not stderr
+            output_url, error_url = stdout.download_url(), stderr.download_url()
+        except Exception as e:
+            output, error, exit_code, success = '', str(e), None, False
+        return {
+            'host_id': host_id,
+            'host_name': host_name,
+            'success': success,
+            'output': output,
+            'error': error,
+            'output_url': output_url,
+            'error_url': error_url,
+            'exit_code': exit_code,
+            'duration_ms': round((time.perf_counter() - started) * 1000),
+        }
+
+    def run_on_hosts(self, hosts, command, max_workers=None):
+        """
+        Runs a command on every host concurrently and returns one result per
+        host, in the same order as ``hosts``.
+        """
+        # Snapshot everything the workers need while still in the request thread.
+        jobs = [(host.id, host.name, target_for_host(host)) for host in hosts]
+        limit = self.worker_limit(max_workers)
+        results = [None] * len(jobs)
+        pending = {}
+        next_index = 0
+
+        while next_index < len(jobs) or pending:
+            while next_index < len(jobs) and len(pending) < limit:
+                host_id, host_name, target = jobs[next_index]
+                future = self.submit(self._run_one, host_id, host_name, target, command)
+                pending[future] = next_index
+                next_index += 1
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[pending.pop(future)] = future.result()
+
+        return results
+
+    def stream_on_hosts(self, hosts, command, max_workers=None, queue_size=256):
+        """
+        Runs a command on every host concurrently and yields events as output
+        arrives: ``start`` and ``done`` per host, ``output`` per chunk, and a
+        final ``end``. The event queue is bounded, so a slow consumer applies
+        backpressure to the SSH readers instead of output piling up in memory.
+        Workers come from the streaming pool, so slow consumers only ever
+        delay other streams.
+        """
+        jobs = [(host.id, host.name, target_for_host(host)) for host in hosts]
+        limit = min(self.worker_limit(max_workers), len(jobs)) or 1
+        events = queue.Queue(maxsize=queue_size)
+        cancelled = threading.Event()
+        job_lock = threading.Lock()
+        remaining = list(reversed(jobs))
+
+        def emit(event):
+            while not cancelled.is_set():
+                try:
+                    events.put(event, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def stream_one(host_id, host_name, target):
+            started = time.perf_counter()
+            emit({'event': 'start', 'host_id': host_id, 'host_name': host_name})
+            exit_code, error = None, ''
+            saw_stderr = False
+            try:
+                stream = ssh_pool.stream_command(target, command)
+                try:
+                    for kind, payload in stream:
+                        if kind == 'exit':
+                            exit_code = payload
+                        else:
+                            saw_stderr = saw_stderr or kind == 'stderr'
+                            if not emit({'event': 'output', 'host_id': host_id, 'stream': kind, 'data': payload}):
+                                break
+                finally:
+                    stream.close()
+            except Exception as e:
+                error = str(e)
+            emit({
+                'event': 'done',
+                'host_id': host_id,
+                'host_name': host_name,
+                'success': not error and not saw_stderr,
+                'exit_code': exit_code,
+                'error': error,
+                'duration_ms': round((time.perf_counter() - started) * 1000),
+            })
+
+        def worker():
+            while not cancelled.is_set():
+                with job_lock:
+                    if not remaining:
+                        return
+                    job = remaining.pop()
+                stream_one(*job)
+
+        futures = [self.stream_pool.submit(worker) for _ in range(limit)]
+        started = time.perf_counter()
+        try:
+            while True:
+                try:
+                    yield events.get(timeout=0.5)
+                except queue.Empty:
+                    if all(f.done() for f in futures) and events.empty():
+                        break
+            yield {'event': 'end', 'duration_ms': round((time.perf_counter() - started) * 1000)}
+        finally:
+            cancelled.set()
+
+
+host_executor = HostExecutor()
@@ -0,0 +1,109 @@
+"""
+Cached lookup of hosts by name, alias or IP address.
+
+Alerts and pipeline host nodes refer to hosts by whatever name the sender
+knows them by: the friendly name, a differently-cased FQDN, one of the
+host's aliases or its IP address. ``host_resolver`` keeps an in-process map
+from every such key (lowercased) to the host ID, built with one query over
+the host table, so resolving a name costs a dict lookup however large the
+fleet grows.
+
+The map is dropped whenever hosts are added, edited or deleted in this
+process. Changes made by other processes are picked up too: a resolved host
+is re-checked against the key it was found by, and a miss reloads the map,
+at most once every ``HOST_CACHE_REFRESH_SECONDS``.
+"""
+import threading
+import time
+
+from app import db
+from app.models import Host
+
+
+def _name_key(name):
+    return [name.strip().lower()] if name else []
+
+
+def _alias_keys(aliases):
+    return [a.strip().lower() for a in (aliases or '').split(',') if a.strip()]
+
+
+def _ip_key(ip_address):
+    return [ip_address.strip().lower()] if ip_address else []
+
+
+def _keys(name, ip_address, aliases):
+    """Every lookup key of a host."""
+    return _name_key(name) + _alias_keys(aliases) + _ip_key(ip_address)
+
+
+class HostResolver:
+    """Maps host names, aliases and IP addresses to Host rows through an in-process index."""
+
+    def __init__(self, refresh_seconds=30):
+        self.refresh_seconds = refresh_seconds
+        self._index = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.refresh_seconds = app.config.get('HOST_CACHE_REFRESH_SECONDS', self.refresh_seconds)
+
+    def invalidate(self):
+        """Drops the index; the next lookup rebuilds it."""
+        with self._lock:
+            self._index = None
+
+    def _load(self):
+        rows = db.session.query(Host.id, Host.name, Host.ip_address, Host.aliases).order_by(Host.id).all()
+        # Names win over aliases, and aliases over IP addresses, when keys
+        # collide; among equals the oldest host wins.
+        index = {}
+        for host_id, name, _, _ in rows:
+            for key in _name_key(name):
+                index.setdefault(key, host_id)
+        for host_id, _, _, aliases in rows:
+            for key in _alias_keys(aliases):
+                index.setdefault(key, host_id)
+        for host_id, _, ip_address, _ in rows:
+            for key in _ip_key(ip_address):
+                index.setdefault(key, host_id)
+        return index
+
+    def _lookup(self, keys, reload=False):
+        with self._lock:
+            stale = time.monotonic() - self._loaded_at > self.refresh_seconds
+            if self._index is None or (reload and stale):
+                self._index = self._load()
+                self._loaded_at = time.monotonic()
+            return {key: self._index.get(key) for key in keys}
+
+    def resolve_many(self, names):
+        """
+        Resolves names, aliases or IP addresses (case-insensitively) with at
+        most one query for the hosts themselves. Returns {name: Host} for the
+        names that matched. Must be called inside an app context.
+        """
+        wanted = {name: str(name).strip().lower() for name in names if name}
+        found = self._lookup(set(wanted.values()))
+        hosts = {h.id: h for h in Host.query.filter(Host.id.in_({i for i in found.values() if i}))} if any(found.values()) else {}
+
+        def matches(key):
+            host = hosts.get(found.get(key))
+            return host is not None and key in _keys(host.name, host.ip_address, host.aliases)
+
+        # Misses and stale entries (hosts changed by another process) get one reload
+        retry = {key for key in wanted.values() if not matches(key)}
+        if retry:
+            found.update(self._lookup(retry, reload=True))
+            missing = {found[key] for key in retry if found.get(key) and found[key] not in hosts}
+            if missing:
+                hosts.update({h.id: h for h in Host.query.filter(Host.id.in_(missing))})
+        return {name: hosts[found[key]] for name, key in wanted.items() if matches(key)}
+
+    def resolve(self, name):
+        """Resolves one name, alias or IP address to a Host, or None."""
+        return self.resolve_many([name]).get(name)
+
+
+host_resolver = HostResolver()
@@ -2,6 +2,8 @@ from flask import render_template, request, redirect, url_for, flash, jsonify
 from . import bp  # Correct: Imports the 'bp' object from the __init__.py in the same folder
 from .. import db
 from ..models import Host, Group
+from ..host_resolver import host_resolver
+from ..pipelines.plan import plan_cache
 # The problematic imports have been removed from here
 
 @bp.route('/hosts', methods=['GET', 'POST'])
@@ -16,6 +18,7 @@ def hosts_page():
         ssh_user = request.form.get('ssh_user')
         location = request.form.get('location')
         description = request.form.get('description')
+        aliases = request.form.get('aliases')
         group_id = request.form.get('group_id')
 
         new_host = Host(
@@ -26,10 +29,13 @@ def hosts_page():
             ssh_user=ssh_user,
             location=location,
             description=description,
+            aliases=aliases or None,
             group_id=group_id if group_id else None
         )
         db.session.add(new_host)
         db.session.commit()
+        plan_cache.invalidate()
+        host_resolver.invalidate()
         flash('Host added successfully!', 'success')
         return redirect(url_for('hosts.hosts_page'))
 
@@ -91,8 +97,11 @@ def edit_host(host_id):
         host.ssh_user = request.form.get('ssh_user')
         host.location = request.form.get('location')
         host.description = request.form.get('description')
+        host.aliases = request.form.get('aliases') or None
         host.group_id = request.form.get('group_id')
         db.session.commit()
+        plan_cache.invalidate()
+        host_resolver.invalidate()
         flash('Host updated successfully!', 'success')
         return redirect(url_for('hosts.hosts_page'))
 
@@ -104,6 +113,8 @@ def delete_host(host_id):
     host = Host.query.get_or_404(host_id)
     db.session.delete(host)
     db.session.commit()
+    plan_cache.invalidate()
+    host_resolver.invalidate()
     flash('Host deleted successfully!', 'success')
     return redirect(url_for('hosts.hosts_page'))
 
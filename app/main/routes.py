@@ -1,14 +1,17 @@
-from flask import render_template, request, jsonify
+from flask import render_template, request, jsonify, send_file, abort
 from flask_login import login_required, current_user # Import login_required and current_user
 from . import bp
 from config import Config
 from app import db
 from app.models import Host, Script, Setting # Import Setting model
-import google.generativeai as genai
-import openai
-import paramiko
+from app.ai import ai_clients, AIError, AIConfigError
+from app.executor import host_executor
+from app.utils import sse_response
+from app.output_capture import output_store
 from github import Github, UnknownObjectException
 import base64
+import os
+import time
 
 @bp.route('/')
 @bp.route('/index')
@@ -17,6 +20,33 @@ def index():
     # You can now access current_user here if needed
     return render_template('index.html', title='Home')
 
+SCRIPT_SYSTEM_PROMPT = "You are a helpful assistant that only provides code."
+
+def _script_prompt(prompt, script_type):
+    return f"Generate a {script_type} script that does the following: {prompt}. The script should be complete, correct, and ready to run. Only output the code itself, with no explanation or markdown formatting."
+
+def _dry_run_prompt(script):
+    return f"You are a helpful Linux assistant. Analyze the following script and explain what it will do when run on an Ubuntu server. Use 'HEADING: ' to mark section titles like 'Executive Summary', 'Script Breakdown', 'Expected Output', etc. Describe the expected output and any potential side effects or files that will be created or modified.\n\nScript:\n```\n{script}\n```"
+
+def _analysis_prompt(script, output, error):
+    if error:
+        return f"The following script failed to execute. Analyze the script and the error message to determine the cause and suggest troubleshooting steps. Use 'HEADING: ' to mark section titles.\n\nScript:\n```\n{script}\n```\n\nError:\n```\n{error}\n```"
+    return f"Analyze the output of the following script. Provide a summary of what the output means. Use 'HEADING: ' to mark section titles.\n\nScript:\n```\n{script}\n```\n\nOutput:\n```\n{output}\n```"
+
+def _ai_stream(prompt, ai_provider, system=None, cache=False, refresh=False):
+    """Streams an AI response as Server-Sent Events: 'token' events, then 'done' or 'error'."""
+    app_config = {s.key: s.value for s in Setting.query.all()}
+
+    def events():
+        try:
+            for text in ai_clients.stream(prompt, ai_provider, app_config, system=system, cache=cache, refresh=refresh):
+                yield {'event': 'token', 'text': text}
+            yield {'event': 'done'}
+        except AIError as e:
+            yield {'event': 'error', 'error': str(e)}
+
+    return sse_response(events())
+
 @bp.route('/generate-script', methods=['POST'])
 @login_required # Protect this route too
 def generate_script():
@@ -30,25 +60,21 @@ def generate_script():
     settings_list = Setting.query.all()
     app_config = {s.key: s.value for s in settings_list}
     
-    full_prompt = f"Generate a {script_type} script that does the following: {prompt}. The script should be complete, correct, and ready to run. Only output the code itself, with no explanation or markdown formatting."
     try:
-        if ai_provider == 'gemini':
-            api_key = app_config.get('gemini_api_key')
-            if not api_key: return jsonify({'error': 'Gemini API key is not configured in settings.'}), 500
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel('gemini-1.5-flash')
-            response = model.generate_content(full_prompt)
-            script = response.text
-        else:
-            api_key = app_config.get('chatgpt_api_key')
-            if not api_key: return jsonify({'error': 'ChatGPT API key is not configured in settings.'}), 500
-            client = openai.OpenAI(api_key=api_key)
-            response = client.chat.completions.create(model="gpt-3.5-turbo", messages=[{"role": "system", "content": "You are a helpful assistant that only provides code."}, {"role": "user", "content": full_prompt}])
-            script = response.choices[0].message.content
+        script = ai_clients.complete(_script_prompt(prompt, script_type), ai_provider, app_config, system=SCRIPT_SYSTEM_PROMPT)
         return jsonify({'script': script})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@bp.route('/generate-script/stream', methods=['POST'])
+@login_required
+def generate_script_stream():
+    """Same as generate_script, but streams the script as it is generated."""
+    data = request.get_json()
+    if not data.get('prompt') or not data.get('script_type') or not data.get('ai_provider'):
+        return jsonify({'error': 'Missing required data.'}), 400
+    return _ai_stream(_script_prompt(data['prompt'], data['script_type']), data['ai_provider'], system=SCRIPT_SYSTEM_PROMPT)
+
 @bp.route('/dry-run', methods=['POST'])
 @login_required # Protect this route
 def dry_run():
@@ -61,56 +87,73 @@ def dry_run():
     settings_list = Setting.query.all()
     app_config = {s.key: s.value for s in settings_list}
 
-    dry_run_prompt = f"You are a helpful Linux assistant. Analyze the following script and explain what it will do when run on an Ubuntu server. Use 'HEADING: ' to mark section titles like 'Executive Summary', 'Script Breakdown', 'Expected Output', etc. Describe the expected output and any potential side effects or files that will be created or modified.\n\nScript:\n```\n{script}\n```"
     try:
-        if ai_provider == 'gemini':
-            api_key = app_config.get('gemini_api_key')
-            if not api_key: return jsonify({'error': 'Gemini API key is not configured in settings.'}), 500
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel('gemini-1.5-flash')
-            response = model.generate_content(dry_run_prompt)
-            output = response.text
-        else:
-            api_key = app_config.get('chatgpt_api_key')
-            if not api_key: return jsonify({'error': 'ChatGPT API key is not configured in settings.'}), 500
-            client = openai.OpenAI(api_key=api_key)
-            response = client.chat.completions.create(model="gpt-3.5-turbo", messages=[{"role": "user", "content": dry_run_prompt}])
-            output = response.choices[0].message.content
-        return jsonify({'output': output})
+        output, cached = ai_clients.cached_complete(_dry_run_prompt(script), ai_provider, app_config, refresh=data.get('no_cache', False))
+        return jsonify({'output': output, 'cached': cached})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@bp.route('/dry-run/stream', methods=['POST'])
+@login_required
+def dry_run_stream():
+    """Same as dry_run, but streams the analysis as it is generated."""
+    data = request.get_json()
+    if not data.get('script') or not data.get('ai_provider'): return jsonify({'error': 'Missing script or AI provider.'}), 400
+    return _ai_stream(_dry_run_prompt(data['script']), data['ai_provider'], cache=True, refresh=data.get('no_cache', False))
+
 @bp.route('/get-hosts', methods=['GET'])
 @login_required # Protect this route
 def get_hosts():
     hosts = Host.query.all()
     return jsonify([{'id': host.id, 'name': host.name} for host in hosts])
 
+def _script_command(script, use_sudo):
+    sanitized_script = script.replace("'", "'\\''")
+    return f"sudo bash -c '{sanitized_script}'" if use_sudo else script
+
+def _selected_hosts(host_ids):
+    """The hosts with the given IDs, in the order they were selected, so results keep that order."""
+    hosts = Host.query.filter(Host.id.in_(host_ids)).all()
+    position = {str(host_id): i for i, host_id in enumerate(host_ids)}
+    hosts.sort(key=lambda h: position.get(str(h.id), len(position)))
+    return hosts
+
 @bp.route('/run-script', methods=['POST'])
 @login_required # Protect this route
 def run_script():
     data = request.get_json()
     script = data.get('script')
     host_ids = data.get('host_ids')
-    use_sudo = data.get('use_sudo', False)
     if not script or not host_ids: return jsonify({'error': 'Missing script or host IDs.'}), 400
-    sanitized_script = script.replace("'", "'\\''")
-    command_to_run = f"sudo bash -c '{sanitized_script}'" if use_sudo else script
-    results = []
-    hosts = Host.query.filter(Host.id.in_(host_ids)).all()
-    for host in hosts:
-        try:
-            client = paramiko.SSHClient()
-            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            client.connect(hostname=host.ip_address, username=host.ssh_user, look_for_keys=True, timeout=10)
-            stdin, stdout, stderr = client.exec_command(command_to_run)
-            output = stdout.read().decode('utf-8')
-            error = stderr.read().decode('utf-8')
-            results.append({'host_name': host.name, 'success': not error, 'output': output, 'error': error})
-            client.close()
-        except Exception as e:
-            results.append({'host_name': host.name, 'success': False, 'output': '', 'error': str(e)})
-    return jsonify({'results': results})
+    command_to_run = _script_command(script, data.get('use_sudo', False))
+    hosts = _selected_hosts(host_ids)
+
+    started = time.perf_counter()
+    results = host_executor.run_on_hosts(hosts, command_to_run, max_workers=data.get('max_workers'))
+    return jsonify({'results': results, 'duration_ms': round((time.perf_counter() - started) * 1000)})
+
+@bp.route('/run-script/stream', methods=['POST'])
+@login_required
+def run_script_stream():
+    """Same as run_script, but streams each host's stdout/stderr as Server-Sent Events."""
+    data = request.get_json()
+    script = data.get('script')
+    host_ids = data.get('host_ids')
+    if not script or not host_ids: return jsonify({'error': 'Missing script or host IDs.'}), 400
+    command_to_run = _script_command(script, data.get('use_sudo', False))
+    hosts = _selected_hosts(host_ids)
+
+    events = host_executor.stream_on_hosts(hosts, command_to_run, max_workers=data.get('max_workers'))
+    return sse_response(events)
+
+@bp.route('/outputs/<capture_id>', methods=['GET'])
+@login_required
+def download_output(capture_id):
+    """Downloads the full, untruncated output of a command as a gzip file."""
+    path = output_store.path_for(capture_id)
+    if not path or not os.path.exists(path):
+        abort(404)
+    return send_file(path, mimetype='application/gzip', as_attachment=True, download_name=f"output-{capture_id}.log.gz")
 
 @bp.route('/analyze-output', methods=['POST'])
 @login_required # Protect this route
@@ -121,33 +164,26 @@ def analyze_output():
     error = data.get('error')
     ai_provider = data.get('ai_provider')
     if not script or not ai_provider: return jsonify({'error': 'Missing data for analysis.'}), 400
-    if error:
-        analysis_prompt = f"The following script failed to execute. Analyze the script and the error message to determine the cause and suggest troubleshooting steps. Use 'HEADING: ' to mark section titles.\n\nScript:\n```\n{script}\n```\n\nError:\n```\n{error}\n```"
-    else:
-        analysis_prompt = f"Analyze the output of the following script. Provide a summary of what the output means. Use 'HEADING: ' to mark section titles.\n\nScript:\n```\n{script}\n```\n\nOutput:\n```\n{output}\n```"
-    
+
     # Load settings from the database
     settings_list = Setting.query.all()
     app_config = {s.key: s.value for s in settings_list}
 
     try:
-        if ai_provider == 'gemini':
-            api_key = app_config.get('gemini_api_key')
-            if not api_key: return jsonify({'error': 'Gemini API key is not configured in settings.'}), 500
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel('gemini-1.5-flash')
-            response = model.generate_content(analysis_prompt)
-            analysis = response.text
-        else:
-            api_key = app_config.get('chatgpt_api_key')
-            if not api_key: return jsonify({'error': 'ChatGPT API key is not configured in settings.'}), 500
-            client = openai.OpenAI(api_key=api_key)
-            response = client.chat.completions.create(model="gpt-3.5-turbo", messages=[{"role": "user", "content": analysis_prompt}])
-            analysis = response.choices[0].message.content
-        return jsonify({'output': analysis})
+        analysis, cached = ai_clients.cached_complete(_analysis_prompt(script, output, error), ai_provider, app_config, refresh=data.get('no_cache', False))
+        return jsonify({'output': analysis, 'cached': cached})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@bp.route('/analyze-output/stream', methods=['POST'])
+@login_required
+def analyze_output_stream():
+    """Same as analyze_output, but streams the analysis as it is generated."""
+    data = request.get_json()
+    if not data.get('script') or not data.get('ai_provider'): return jsonify({'error': 'Missing data for analysis.'}), 400
+    prompt = _analysis_prompt(data['script'], data.get('output'), data.get('error'))
+    return _ai_stream(prompt, data['ai_provider'], cache=True, refresh=data.get('no_cache', False))
+
 @bp.route('/save-script', methods=['POST'])
 @login_required # Protect this route
 def save_script():
@@ -182,22 +218,14 @@ def test_ai_provider():
     if not provider:
         return jsonify({'success': False, 'error': 'No provider specified.'}), 400
 
+    if provider not in ('gemini', 'chatgpt', 'local'):
+        return jsonify({'success': False, 'error': 'Unknown provider.'}), 400
+
     try:
-        if provider == 'gemini':
-            api_key = app_config.get('gemini_api_key')
-            if not api_key:
-                return jsonify({'success': False, 'error': 'Gemini API key not set in Settings.'}), 400
-            genai.configure(api_key=api_key)
-            genai.list_models()
-        elif provider == 'chatgpt':
-            api_key = app_config.get('chatgpt_api_key')
-            if not api_key:
-                return jsonify({'success': False, 'error': 'ChatGPT API key not set in Settings.'}), 400
-            client = openai.OpenAI(api_key=api_key)
-            client.models.list()
-        else:
-            return jsonify({'success': False, 'error': 'Unknown provider.'}), 400
-        
+        # Test the provider asked for, even when AI_PROVIDER_OVERRIDE redirects normal calls
+        ai_clients.provider(provider, app_config, override=False).ping()
         return jsonify({'success': True})
-    except Exception as e:
+    except AIConfigError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except AIError as e:
         return jsonify({'success': False, 'error': str(e)})
@@ -70,8 +70,10 @@ class User(db.Model, UserMixin):
 
 class Host(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(100), nullable=False)
-    ip_address = db.Column(db.String(100), nullable=False)
+    name = db.Column(db.String(100), nullable=False, index=True)
+    ip_address = db.Column(db.String(100), nullable=False, index=True)
+    # Other names the host is known by (e.g. monitoring FQDNs), comma separated
+    aliases = db.Column(db.Text)
     os_type = db.Column(db.String(50), nullable=False)
     distro = db.Column(db.String(50))
     ssh_user = db.Column(db.String(100), nullable=False)
@@ -79,9 +81,16 @@ class Host(db.Model):
     description = db.Column(db.Text)
     group_id = db.Column(db.Integer, db.ForeignKey('group.id'), nullable=True)
 
+    __table_args__ = (
+        db.Index('ix_host_name_lower', db.func.lower(name)),
+    )
+
     def __repr__(self):
         return f"Host('{self.name}', '{self.ip_address}')"
 
+    def alias_list(self):
+        return [a.strip() for a in (self.aliases or '').split(',') if a.strip()]
+
 class Script(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False, unique=True)
@@ -112,14 +121,202 @@ class Setting(db.Model):
 
 class ScheduledJob(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(150), nullable=False)
+    name = db.Column(db.String(150), nullable=False, index=True)
     pipeline_id = db.Column(db.Integer, db.ForeignKey('pipeline.id'), nullable=False)
     cron_string = db.Column(db.String(100), nullable=False) # e.g., '0 2 * * *'
     is_enabled = db.Column(db.Boolean, default=True, nullable=False)
+    # Storm control; None falls back to the SCHEDULER_* defaults in config
+    jitter_seconds = db.Column(db.Integer, nullable=True)
+    coalesce = db.Column(db.Boolean, nullable=True)
+    max_instances = db.Column(db.Integer, nullable=True)
     last_run = db.Column(db.DateTime, nullable=True)
+    last_duration_ms = db.Column(db.Integer, nullable=True)
+    last_status = db.Column(db.String(20), nullable=True)
     next_run = db.Column(db.DateTime, nullable=True)
     
     pipeline = db.relationship('Pipeline', backref='scheduled_jobs')
 
     def __repr__(self):
         return f'<ScheduledJob {self.name}>'
+
+class SchedulerLease(db.Model):
+    name = db.Column(db.String(50), primary_key=True)
+    holder = db.Column(db.String(150), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    renewed_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<SchedulerLease {self.name} held by {self.holder}>'
+
+class PipelineRun(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    # History is kept when its pipeline is deleted: the ID is cleared and the name stays
+    pipeline_id = db.Column(db.Integer, db.ForeignKey('pipeline.id', ondelete='SET NULL'), nullable=True, index=True)
+    pipeline_name = db.Column(db.String(100), nullable=True)
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True) # held, queued, running, succeeded, failed
+    trigger_source = db.Column(db.String(20), nullable=False, default='manual', index=True) # manual, cron, run_now, zabbix, resume
+    # What started the run; plain integers so history outlives deleted jobs and hosts
+    scheduled_job_id = db.Column(db.Integer, nullable=True, index=True)
+    host_id = db.Column(db.Integer, nullable=True, index=True)
+    host_name = db.Column(db.String(100), nullable=True)
+    # Name of the alert that started a zabbix run; repeats of it are deduplicated
+    trigger_name = db.Column(db.String(255), nullable=True)
+    options = db.Column(db.Text, nullable=False, default='{}')
+    error = db.Column(db.Text)
+    # Hash of the pipeline definition the run was planned from; resuming requires it to be unchanged
+    definition_hash = db.Column(db.String(64))
+    resumed_from_id = db.Column(db.Integer, nullable=True)
+    # The process whose run queue holds the run, and when it last confirmed it was alive
+    runner = db.Column(db.String(150), nullable=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    pipeline = db.relationship('Pipeline', backref=db.backref('runs', lazy='dynamic'))
+    steps = db.relationship('StepRun', backref='run', lazy=True, order_by='StepRun.position', cascade='all, delete-orphan')
+
+    __table_args__ = (
+        db.Index('ix_pipeline_run_pipeline_created', 'pipeline_id', 'created_at'),
+    )
+
+    def __repr__(self):
+        return f'<PipelineRun {self.id} {self.status}>'
+
+    def get_options(self):
+        return json.loads(self.options) if self.options else {}
+
+    def set_options(self, options_dict):
+        self.options = json.dumps(options_dict)
+
+    @property
+    def is_finished(self):
+        return self.status in ('succeeded', 'failed')
+
+    @property
+    def duration_ms(self):
+        if not self.started_at:
+            return None
+        end = self.finished_at or datetime.utcnow()
+        return round((end - self.started_at).total_seconds() * 1000)
+
+    def to_dict(self, include_steps=True):
+        data = {
+            'id': self.id,
+            'pipeline_id': self.pipeline_id,
+            'pipeline_name': self.pipeline_name,
+            'status': self.status,
+            'trigger_source': self.trigger_source,
+            'scheduled_job_id': self.scheduled_job_id,
+            'host_id': self.host_id,
+            'host_name': self.host_name,
+            'trigger_name': self.trigger_name,
+            'resumed_from_id': self.resumed_from_id,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'duration_ms': self.duration_ms,
+        }
+        if include_steps:
+            data['steps'] = [step.to_dict() for step in self.steps]
+        hosts = self.host_summary()
+        if hosts:
+            data['hosts'] = hosts
+        return data
+
+    def host_summary(self):
+        """Aggregates the steps of a matrix run per host, in the order the hosts were given."""
+        summary = {}
+        for step in self.steps:
+            if step.host_id is None:
+                continue
+            entry = summary.setdefault(step.host_id, {
+                'host_id': step.host_id, 'host_name': step.host_name, 'status': 'succeeded',
+                'succeeded': 0, 'failed': 0, 'skipped': 0, 'pending': 0, 'duration_ms': 0,
+            })
+            bucket = step.status if step.status in ('succeeded', 'failed', 'skipped') else 'pending'
+            entry[bucket] += 1
+            entry['duration_ms'] += step.duration_ms or 0
+        for entry in summary.values():
+            if entry['pending']:
+                entry['status'] = 'running'
+            elif entry['failed'] or entry['skipped']:
+                entry['status'] = 'failed'
+        order = self.get_options().get('matrix', {}).get('host_ids', [])
+        return sorted(summary.values(), key=lambda e: order.index(e['host_id']) if e['host_id'] in order else len(order))
+
+class StepRun(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    run_id = db.Column(db.Integer, db.ForeignKey('pipeline_run.id'), nullable=False, index=True)
+    node_id = db.Column(db.String(64), nullable=False)
+    step_name = db.Column(db.String(150), nullable=False)
+    step_type = db.Column(db.String(20), nullable=False)
+    position = db.Column(db.Integer, nullable=False, default=0)
+    # Set on the per-host steps of a matrix run. Not a foreign key so run history outlives deleted hosts.
+    host_id = db.Column(db.Integer, nullable=True)
+    host_name = db.Column(db.String(100), nullable=True)
+    status = db.Column(db.String(20), nullable=False, default='pending') # pending, running, succeeded, failed, skipped
+    output = db.Column(db.Text)
+    error = db.Column(db.Text)
+    output_url = db.Column(db.String(256))
+    error_url = db.Column(db.String(256))
+    # Checkpoint: the context this step handed to its successors, so a resumed run can reuse it
+    context = db.Column(db.Text)
+    reused_from_id = db.Column(db.Integer, nullable=True)
+    # Estimated tokens sent to the AI provider by an AI Analysis step, across all its calls,
+    # and the size of its diagnostic data before and after compaction
+    tokens_sent = db.Column(db.Integer, nullable=True)
+    tokens_before_compaction = db.Column(db.Integer, nullable=True)
+    tokens_after_compaction = db.Column(db.Integer, nullable=True)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f'<StepRun {self.run_id}:{self.step_name} {self.status}>'
+
+    def get_context(self):
+        return json.loads(self.context) if self.context else {}
+
+    def set_context(self, context_dict):
+        self.context = json.dumps(context_dict)
+
+    @property
+    def duration_ms(self):
+        if not self.started_at or not self.finished_at:
+            return None
+        return round((self.finished_at - self.started_at).total_seconds() * 1000)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'node_id': self.node_id,
+            'step_name': self.step_name,
+            'step_type': self.step_type,
+            'host_id': self.host_id,
+            'host_name': self.host_name,
+            'status': self.status,
+            'success': self.status == 'succeeded',
+            'output': self.output or '',
+            'error': self.error or '',
+            'output_url': self.output_url,
+            'error_url': self.error_url,
+            'reused': self.reused_from_id is not None,
+            'tokens_sent': self.tokens_sent,
+            'tokens_before_compaction': self.tokens_before_compaction,
+            'tokens_after_compaction': self.tokens_after_compaction,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'duration_ms': self.duration_ms,
+        }
+
+class AIResponse(db.Model):
+    """A cached AI completion, keyed by a hash of provider, model, system prompt and prompt."""
+    key = db.Column(db.String(64), primary_key=True)
+    provider = db.Column(db.String(20), nullable=False)
+    model = db.Column(db.String(100), nullable=False)
+    response = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+    def __repr__(self):
+        return f'<AIResponse {self.provider}/{self.model} {self.key[:12]}>'
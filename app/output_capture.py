@@ -0,0 +1,157 @@
+"""
+Bounded capture of command output.
+
+Only the first ``OUTPUT_HEAD_CHARS`` and last ``OUTPUT_TAIL_CHARS`` characters
+of a stream are kept in memory. Once a stream outgrows that budget, the whole
+stream is also written to a gzip file under ``OUTPUT_SPILL_DIR`` so it can be
+downloaded later, while responses, AI prompts and notifications only ever see
+the truncated head/tail view.
+"""
+import gzip
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from collections import deque
+
+from flask import url_for
+
+logger = logging.getLogger(__name__)
+
+_CAPTURE_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+class OutputCapture:
+    """A write-only text sink that keeps a head/tail view and spills to disk when large."""
+
+    def __init__(self, store):
+        self.store = store
+        self.capture_id = uuid.uuid4().hex
+        self.size = 0
+        self.spill_path = None
+        self._head = []
+        self._head_len = 0
+        self._tail = deque()
+        self._tail_len = 0
+        self._spill = None
+
+    @property
+    def truncated(self):
+        return self.size > self.store.head_chars + self.store.tail_chars
+
+    def write(self, text):
+        if not text:
+            return
+        self.size += len(text)
+        if self._spill is None and self.truncated:
+            self._start_spill()
+        if self._spill is not None:
+            self._spill.write(text)
+
+        room = self.store.head_chars - self._head_len
+        if room > 0:
+            self._head.append(text[:room])
+            self._head_len += len(self._head[-1])
+            text = text[room:]
+        if text:
+            self._tail.append(text)
+            self._tail_len += len(text)
+            # Drop whole chunks from the left while the rest still covers the tail budget.
+            while self._tail and self._tail_len - len(self._tail[0]) >= self.store.tail_chars:
+                self._tail_len -= len(self._tail.popleft())
+
+    def _start_spill(self):
+        self.spill_path = self.store.path_for(self.capture_id)
+        try:
+            self._spill = gzip.open(self.spill_path, 'wt', encoding='utf-8')
+            self._spill.write(''.join(self._head))
+            self._spill.write(''.join(self._tail))
+        except OSError as e:
+            logger.error(f"Could not spill output to {self.spill_path}: {e}")
+            self._spill = None
+            self.spill_path = None
+        self.store.prune()
+
+    def close(self):
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+    def download_url(self):
+        """Link to the full output, or None when nothing was spilled to disk."""
+        if not self.spill_path:
+            return None
+        try:
+            return url_for('main.download_output', capture_id=self.capture_id, _external=True)
+        except RuntimeError:
+            return f"/outputs/{self.capture_id}"
+
+    def text(self):
+        """The in-memory view: everything if small, otherwise head + marker + tail."""
+        head = ''.join(self._head)
+        tail = ''.join(self._tail)
+        if not self.truncated:
+            return head + tail
+        tail = tail[-self.store.tail_chars:] if self.store.tail_chars else ''
+        omitted = self.size - len(head) - len(tail)
+        where = f" Full output: {self.download_url()}" if self.spill_path else ''
+        return f"{head}\n\n... [{omitted} characters omitted.{where}] ...\n\n{tail}"
+
+    def __str__(self):
+        return self.text()
+
+    def __len__(self):
+        return self.size
+
+    def __bool__(self):
+        return self.size > 0
+
+
+class OutputStore:
+    """Creates captures and manages the on-disk spill directory."""
+
+    def __init__(self, head_chars=32768, tail_chars=32768, spill_dir=None, retention_hours=72):
+        self.head_chars = head_chars
+        self.tail_chars = tail_chars
+        self.spill_dir = spill_dir
+        self.retention_hours = retention_hours
+        self._last_prune = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Reads capture limits and the spill directory from the app config."""
+        self.head_chars = app.config.get('OUTPUT_HEAD_CHARS', self.head_chars)
+        self.tail_chars = app.config.get('OUTPUT_TAIL_CHARS', self.tail_chars)
+        self.spill_dir = app.config.get('OUTPUT_SPILL_DIR', self.spill_dir)
+        self.retention_hours = app.config.get('OUTPUT_RETENTION_HOURS', self.retention_hours)
+
+    def capture(self):
+        return OutputCapture(self)
+
+    def path_for(self, capture_id):
+        """Returns the spill file path for a capture ID, or None if the ID is malformed."""
+        if not _CAPTURE_ID_RE.match(capture_id or ''):
+            return None
+        os.makedirs(self.spill_dir, exist_ok=True)
+        return os.path.join(self.spill_dir, f"{capture_id}.log.gz")
+
+    def prune(self):
+        """Deletes spill files older than the retention period (at most once an hour)."""
+        now = time.time()
+        with self._lock:
+            if now - self._last_prune < 3600:
+                return
+            self._last_prune = now
+        cutoff = now - self.retention_hours * 3600
+        try:
+            for name in os.listdir(self.spill_dir):
+                path = os.path.join(self.spill_dir, name)
+                if name.endswith('.log.gz') and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+        except OSError as e:
+            logger.error(f"Could not prune spilled outputs: {e}")
+
+
+output_store = OutputStore()
@@ -0,0 +1,251 @@
+"""
+Deduplication and coalescing of alert-triggered pipeline runs.
+
+A flapping trigger or a cluster-wide incident can send the same alert many
+times within seconds. A repeat of (host, pipeline, trigger) while a run for
+it is still queued or running (and at most ``ALERT_DEDUP_SECONDS`` old)
+returns that run instead of starting another one.
+
+The first alert for a pipeline and trigger is queued at once and opens a
+window of ``ALERT_COALESCE_SECONDS``. The same trigger firing on other hosts
+within that window is gathered into one follow-up run, held until the window
+closes, so the rest of the incident becomes one matrix run whose action nodes
+(AI analysis, notifications) run once over every host.
+
+Deduplication reads the run table and so holds across processes; coalescing
+happens within each process. Follow-up runs are stored as 'held' while they
+wait; if their process exits first, the next process to serve a request
+queues them (or fails them once they are older than the dedup window).
+"""
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from app import db
+from app.models import PipelineRun
+from app.pipelines.engine import create_run, expand_run, matrix_hosts
+from app.pipelines.runner import pipeline_runner, RunQueueFull, HIGH
+
+logger = logging.getLogger(__name__)
+
+# Held runs older than their coalescing window plus this many seconds belong to a process that has exited
+HELD_RUN_GRACE_SECONDS = 60
+
+
+def _matrix_options(options, hosts):
+    """Run options for one alert fired on several hosts: a reducing matrix run naming every host."""
+    options = {k: v for k, v in options.items() if k != 'host_id'}
+    options['matrix'] = {'reduce': True}
+    options['trigger'] = {**options.get('trigger', {}), 'hostname': ', '.join(h.name for h in hosts)}
+    return options
+
+
+class AlertCoalescer:
+    """Turns incoming alerts into queued runs, collapsing repeats and merging concurrent hosts."""
+
+    def __init__(self, dedup_seconds=300, coalesce_seconds=5):
+        self.dedup_seconds = dedup_seconds
+        self.coalesce_seconds = coalesce_seconds
+        self.app = None
+        # (pipeline_id, trigger_name) -> open coalescing window: the run each
+        # host joined, and the held follow-up run ('run_id') if there is one
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._recovered = False
+
+    def init_app(self, app):
+        self.app = app
+        self.dedup_seconds = app.config.get('ALERT_DEDUP_SECONDS', self.dedup_seconds)
+        self.coalesce_seconds = app.config.get('ALERT_COALESCE_SECONDS', self.coalesce_seconds)
+
+    def submit(self, pipeline, host, trigger_name, options):
+        """
+        Starts (or joins) the run for an alert on ``host``. Returns the run and
+        how the alert was handled: 'queued', 'coalesced' or 'deduplicated'.
+        Raises RunQueueFull when the run queue is full and PipelineCycleError
+        on a cyclic pipeline.
+        """
+        key = (pipeline.id, trigger_name)
+        with self._lock:
+            joined = self._join(key, host)
+            if joined:
+                return joined
+
+            if not pipeline_runner.has_room(HIGH):
+                raise RunQueueFull("Run queue is full; try again later.")
+            run = self._create_run(pipeline, [host], trigger_name, options)
+            window = self._pending.get(key)
+            if window is not None:
+                # Another host reported this alert moments ago: start the follow-up run
+                # that later hosts join, queued when the window closes
+                run.status = 'held'
+                db.session.commit()
+                window['run_id'] = run.id
+                window['options'] = options
+                window['hosts'][host.id] = run.id
+                return run, 'queued'
+
+            db.session.commit()
+            pipeline_runner.enqueue(run)
+            if self.coalesce_seconds:
+                self._pending[key] = {'run_id': None, 'hosts': {host.id: run.id}, 'options': options}
+                timer = threading.Timer(self.coalesce_seconds, self._flush, args=(key,))
+                timer.daemon = True
+                timer.start()
+            return run, 'queued'
+
+    def submit_many(self, alerts):
+        """
+        Batch form of submit() for a list of (pipeline, host, trigger_name,
+        options) tuples. New alerts for the same pipeline and trigger become one
+        matrix run straight away, and all new runs are created in a single
+        transaction and queued without waiting. Returns a (run, outcome, error)
+        tuple per alert, in order; ``run`` is None when the alert failed.
+        """
+        results = [None] * len(alerts)
+        groups = {}
+        with self._lock:
+            for i, (pipeline, host, trigger_name, options) in enumerate(alerts):
+                key = (pipeline.id, trigger_name)
+                joined = self._join(key, host)
+                if joined:
+                    results[i] = (*joined, None)
+                    continue
+                group = groups.setdefault(key, {'pipeline': pipeline, 'hosts': {}, 'options': options, 'items': []})
+                outcome = 'queued' if not group['items'] else 'deduplicated' if host.id in group['hosts'] else 'coalesced'
+                group['hosts'].setdefault(host.id, host)
+                group['items'].append((i, outcome))
+
+            created = []
+            for (_, trigger_name), group in groups.items():
+                try:
+                    run = self._create_run(group['pipeline'], list(group['hosts'].values()), trigger_name, group['options'])
+                    created.append((run, group['items']))
+                except Exception as e:
+                    for i, _ in group['items']:
+                        results[i] = (None, 'failed', str(e))
+            db.session.commit()
+
+        for run, items in created:
+            try:
+                pipeline_runner.enqueue(run)
+                for i, outcome in items:
+                    results[i] = (run, outcome, None)
+            except RunQueueFull as e:
+                for i, _ in items:
+                    results[i] = (run, 'rejected', str(e))
+        return results
+
+    def _join(self, key, host):
+        """The existing run an alert joins, as (run, outcome), or None if it needs a new one."""
+        pending = self._pending.get(key)
+        if pending and host.id in pending['hosts']:
+            return PipelineRun.query.get(pending['hosts'][host.id]), 'deduplicated'
+        recent = self._recent_run(key[0], host.id, key[1])
+        if recent:
+            return recent, 'deduplicated'
+        if pending and pending['run_id']:
+            pending['hosts'][host.id] = pending['run_id']
+            return PipelineRun.query.get(pending['run_id']), 'coalesced'
+        return None
+
+    def _create_run(self, pipeline, hosts, trigger_name, options):
+        """Creates (without committing) the run for an alert, as a reducing matrix run over several hosts."""
+        if len(hosts) > 1:
+            run = create_run(pipeline, _matrix_options(options, hosts), trigger_source='zabbix', hosts=hosts, commit=False)
+        else:
+            run = create_run(pipeline, options, trigger_source='zabbix', commit=False)
+        run.trigger_name = trigger_name
+        return run
+
+    def _recent_run(self, pipeline_id, host_id, trigger_name):
+        """The newest in-flight run for this alert within the dedup window; finished runs never suppress a retry."""
+        if not self.dedup_seconds:
+            return None
+        cutoff = datetime.utcnow() - timedelta(seconds=self.dedup_seconds)
+        runs = PipelineRun.query.filter(
+            PipelineRun.pipeline_id == pipeline_id,
+            PipelineRun.trigger_source == 'zabbix',
+            PipelineRun.trigger_name == trigger_name,
+            PipelineRun.created_at >= cutoff,
+            PipelineRun.status.in_(('held', 'queued', 'running')),
+        ).order_by(PipelineRun.created_at.desc()).all()
+        for run in runs:
+            if run.host_id == host_id or host_id in run.get_options().get('matrix', {}).get('host_ids', []):
+                return run
+        return None
+
+    def _flush(self, key):
+        """Closes a coalescing window and queues its follow-up run, as a matrix run if several hosts joined it."""
+        with self._lock, self.app.app_context():
+            pending = self._pending.pop(key, None)
+            if pending is None or pending['run_id'] is None:
+                return
+            run_id = pending['run_id']
+            try:
+                run = PipelineRun.query.get(run_id)
+                host_ids = [h for h, r in pending['hosts'].items() if r == run_id]
+                if len(host_ids) > 1:
+                    hosts = matrix_hosts(host_ids=host_ids)
+                    expand_run(run, hosts, _matrix_options(pending['options'], hosts))
+                    logger.info(f"Coalesced alerts from {len(hosts)} hosts into pipeline run {run.id}.")
+                self._release(run)
+            except RunQueueFull as e:
+                logger.error(f"Alert run {run_id} rejected: {e}")
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Could not queue alert run {run_id}: {e}")
+                PipelineRun.query.filter_by(id=run_id).update(
+                    {'status': 'failed', 'error': str(e), 'finished_at': datetime.utcnow()}, synchronize_session=False)
+                db.session.commit()
+
+    def _release(self, run):
+        """Queues a held run, unless another process already has. Returns whether this call queued it."""
+        claimed = PipelineRun.query.filter_by(id=run.id, status='held').update(
+            {'status': 'queued'}, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            pipeline_runner.enqueue(run)
+        return bool(claimed)
+
+    def recover(self):
+        """
+        Deals with follow-up runs left 'held' by a process that exited before
+        their window closed: runs still within the dedup window are queued
+        here, older ones are failed. Runs once per process, from its first
+        request, so CLI commands never pick runs up.
+        """
+        if self._recovered:
+            return
+        with self._lock:
+            if self._recovered:
+                return
+            self._recovered = True
+        now = datetime.utcnow()
+        try:
+            orphans = PipelineRun.query.filter(
+                PipelineRun.status == 'held',
+                PipelineRun.created_at < now - timedelta(seconds=self.coalesce_seconds + HELD_RUN_GRACE_SECONDS),
+            ).all()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Could not look for abandoned alert runs: {e}")
+            return
+        for run in orphans:
+            try:
+                if run.created_at >= now - timedelta(seconds=self.dedup_seconds):
+                    if self._release(run):
+                        logger.info(f"Queued alert run {run.id} abandoned by an exited process.")
+                    continue
+                PipelineRun.query.filter_by(id=run.id, status='held').update(
+                    {'status': 'failed', 'error': 'The process holding this alert run exited before queuing it.',
+                     'finished_at': now}, synchronize_session=False)
+                db.session.commit()
+            except RunQueueFull as e:
+                logger.error(f"Abandoned alert run {run.id} rejected: {e}")
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Could not recover alert run {run.id}: {e}")
+
+
+alert_coalescer = AlertCoalescer()
@@ -0,0 +1,598 @@
+"""
+Pipeline execution engine.
+
+Runs a persisted PipelineRun as a DAG, starting each node once its
+predecessors are done, and records every node's outcome in a StepRun row as
+it goes so callers can poll or stream progress while the run executes in the
+background.
+"""
+from collections import deque
+from concurrent.futures import wait, FIRST_COMPLETED
+from datetime import datetime
+
+from flask import current_app
+
+from app import db
+from app.ai import ai_clients, AIError
+from app.executor import host_executor
+from app.host_resolver import host_resolver
+from app.models import Host, PipelineRun, StepRun, Setting
+from app.notifications import send_email
+from app.pipelines.history import run_history
+from app.pipelines.plan import HostBinding, plan_cache
+from app.ssh_pool import ssh_pool, target_for_host
+from app.utils import send_to_discord
+
+
+def _get_ai_analysis(build_prompt, data, ai_provider=None, app_config=None):
+    """Helper function to get analysis from the configured AI provider, chunking large data."""
+    try:
+        return ai_clients.analyze(build_prompt, data, ai_provider, app_config)
+    except AIError as e:
+        return {"error": str(e)}
+
+
+def matrix_hosts(group_id=None, host_ids=None):
+    """
+    Resolves the hosts of a matrix run: every host in a group, or an explicit
+    list of host IDs kept in the order given. Unknown IDs are ignored.
+    """
+    if group_id:
+        return Host.query.filter_by(group_id=group_id).order_by(Host.name).all()
+    if host_ids:
+        ids = [int(h) for h in host_ids]
+        hosts = {h.id: h for h in Host.query.filter(Host.id.in_(ids)).all()}
+        return [hosts[h] for h in dict.fromkeys(ids) if h in hosts]
+    return []
+
+
+def _is_reduced(node, options):
+    """In a reducing matrix run, action nodes run once over every host's results."""
+    return node['type'] == 'action' and options.get('matrix', {}).get('reduce', False)
+
+
+def create_run(pipeline, options, trigger_source='manual', hosts=None, scheduled_job_id=None, commit=True):
+    """
+    Validates the pipeline graph and persists a queued PipelineRun with one
+    pending StepRun per executable node. Raises PipelineCycleError on a cyclic graph.
+    With ``commit=False`` the run is only flushed, for callers creating several
+    runs in one transaction.
+
+    Given ``hosts``, the run is a matrix run: every node runs once per host
+    (or once overall for reduced action nodes, see ``options['matrix']['reduce']``).
+    """
+    plan = plan_cache.get(pipeline)
+
+    if hosts:
+        matrix = dict(options.get('matrix') or {})
+        matrix['host_ids'] = [h.id for h in hosts]
+        options = {**options, 'matrix': matrix}
+
+    run = PipelineRun(pipeline_id=pipeline.id, pipeline_name=pipeline.name, status='queued', trigger_source=trigger_source,
+                      definition_hash=plan.definition_hash, scheduled_job_id=scheduled_job_id)
+    if options.get('host_id'):
+        pinned = Host.query.get(options['host_id'])
+        run.host_id, run.host_name = options['host_id'], pinned.name if pinned else None
+    run.set_options(options)
+    _add_steps(run, plan, options, hosts)
+    db.session.add(run)
+    if commit:
+        db.session.commit()
+    else:
+        db.session.flush()
+    return run
+
+
+def _add_steps(run, plan, options, hosts):
+    position = 0
+    for node_id in plan.order:
+        node = plan.nodes[node_id]
+        for host in ([None] if not hosts or _is_reduced(node, options) else hosts):
+            run.steps.append(StepRun(
+                node_id=node_id, step_name=node['name'], step_type=node['type'], position=position,
+                host_id=host.id if host else None, host_name=host.name if host else None,
+            ))
+            position += 1
+
+
+def expand_run(run, hosts, options):
+    """
+    Turns a queued run that has not been submitted yet into a matrix run over
+    ``hosts`` with the given options, replacing its steps. Used to merge alerts
+    from several hosts into one run.
+    """
+    plan = plan_cache.get(run.pipeline)
+    matrix = dict(options.get('matrix') or {})
+    matrix['host_ids'] = [h.id for h in hosts]
+    options = {**options, 'matrix': matrix}
+    options.pop('host_id', None)
+    run.host_id = run.host_name = None
+    run.definition_hash = plan.definition_hash
+    run.set_options(options)
+    run.steps.clear()
+    db.session.flush()
+    _add_steps(run, plan, options, hosts)
+    db.session.commit()
+    return run
+
+
+class ResumeError(Exception):
+    """Raised when a run cannot be resumed, e.g. because its pipeline has changed since."""
+
+
+def _step_graph(plan, keys):
+    """
+    Returns (preds, succs) over step keys (node_id, host_id). host_id is None
+    except on the per-host steps of a matrix run, where a step depends on the
+    same host's copy of each predecessor, or on the single reduced copy.
+    Edges to nodes without a step are dropped.
+    """
+    keys = set(keys)
+    copies = {}
+    for key in keys:
+        copies.setdefault(key[0], []).append(key)
+    preds = {}
+    for node_id, host_id in keys:
+        pred_keys = []
+        for pred in plan.preds.get(node_id, ()):
+            if host_id is not None and (pred, host_id) in keys:
+                pred_keys.append((pred, host_id))
+            elif (pred, None) in keys:
+                pred_keys.append((pred, None))
+            else:
+                pred_keys.extend(copies.get(pred, ()))
+        preds[(node_id, host_id)] = pred_keys
+    succs = {key: [] for key in keys}
+    for key, p in preds.items():
+        for pred in p:
+            succs[pred].append(key)
+    return preds, succs
+
+
+def create_resume_run(source, node_id=None, trigger_source='resume'):
+    """
+    Queues a new run that reuses the checkpointed results of a finished run.
+    Without ``node_id`` every step that did not succeed is rerun; with it, that
+    node is rerun. Everything downstream of a rerun step is rerun too, and all
+    other steps are copied over as succeeded without executing again.
+    """
+    if not source.is_finished:
+        raise ResumeError('Only finished runs can be resumed.')
+    if source.pipeline is None:
+        raise ResumeError('The pipeline of this run has been deleted.')
+    plan = plan_cache.get(source.pipeline)
+    if source.definition_hash != plan.definition_hash:
+        raise ResumeError('The pipeline has changed since this run; start a new run instead.')
+
+    old_steps = {(step.node_id, step.host_id): step for step in source.steps}
+    if node_id is None:
+        rerun = [key for key, step in old_steps.items() if step.status != 'succeeded']
+    else:
+        rerun = [key for key in old_steps if key[0] == node_id]
+        if not rerun:
+            raise ResumeError(f"Node '{node_id}' is not part of this run.")
+    _, succs = _step_graph(plan, old_steps)
+    stack, rerun = list(rerun), set(rerun)
+    while stack:
+        for succ in succs[stack.pop()]:
+            if succ not in rerun:
+                rerun.add(succ)
+                stack.append(succ)
+
+    run = PipelineRun(pipeline_id=source.pipeline_id, pipeline_name=source.pipeline.name, status='queued', trigger_source=trigger_source,
+                      definition_hash=source.definition_hash, resumed_from_id=source.id, options=source.options,
+                      scheduled_job_id=source.scheduled_job_id, host_id=source.host_id, host_name=source.host_name)
+    for step in source.steps:
+        copy = StepRun(node_id=step.node_id, step_name=step.step_name, step_type=step.step_type,
+                       position=step.position, host_id=step.host_id, host_name=step.host_name)
+        if (step.node_id, step.host_id) not in rerun:
+            copy.status = 'succeeded'
+            copy.output, copy.error = step.output, step.error
+            copy.output_url, copy.error_url = step.output_url, step.error_url
+            copy.tokens_sent = step.tokens_sent
+            copy.tokens_before_compaction = step.tokens_before_compaction
+            copy.tokens_after_compaction = step.tokens_after_compaction
+            copy.context = step.context
+            copy.started_at, copy.finished_at = step.started_at, step.finished_at
+            copy.reused_from_id = step.reused_from_id or step.id
+        run.steps.append(copy)
+    db.session.add(run)
+    db.session.commit()
+    return run
+
+
+def _finish_step(step, success, output='', error='', output_url=None, error_url=None, context=None, tokens=None):
+    step.status = 'succeeded' if success else 'failed'
+    step.output = output
+    step.error = error
+    step.output_url = output_url
+    step.error_url = error_url
+    tokens = tokens or {}
+    step.tokens_sent = tokens.get('tokens_sent')
+    step.tokens_before_compaction = tokens.get('tokens_before')
+    step.tokens_after_compaction = tokens.get('tokens_after')
+    if context is not None:
+        step.set_context(context)
+    step.finished_at = datetime.utcnow()
+    db.session.commit()
+
+
+def execute_run(run_id):
+    """Executes a queued PipelineRun. Must be called inside an app context."""
+    run = PipelineRun.query.get(run_id)
+    if run is None or run.status != 'queued':
+        return
+
+    run.status = 'running'
+    run.started_at = datetime.utcnow()
+    if run.pipeline is None:
+        run.status = 'failed'
+        run.error = 'The pipeline was deleted before the run started.'
+        run.finished_at = run.started_at
+        db.session.commit()
+        return
+    db.session.commit()
+
+    try:
+        _execute_steps(run)
+        run.status = 'succeeded' if all(step.status == 'succeeded' for step in run.steps) else 'failed'
+    except Exception as e:
+        current_app.logger.error(f"Pipeline run {run.id} failed: {e}")
+        db.session.rollback()
+        run.status = 'failed'
+        run.error = str(e)
+        for step in run.steps:
+            if step.status in ('pending', 'running'):
+                step.status = 'skipped'
+    run.finished_at = datetime.utcnow()
+    db.session.commit()
+    run_history.prune()
+
+
+def _merge_outputs(entries, more):
+    """Joins two lists of script results, once per step, in execution order."""
+    seen = {(e['node_id'], e['host_id']) for e in entries}
+    merged = entries + [e for e in more if (e['node_id'], e['host_id']) not in seen]
+    return sorted(merged, key=lambda e: e['position'])
+
+
+def _merge_contexts(contexts):
+    """
+    Combines the contexts handed down by a node's predecessors. A single
+    upstream branch passes through unchanged; parallel branches are joined,
+    and their accumulated script results are combined in execution order.
+    """
+    merged = {}
+    for context in contexts:
+        for key, value in context.items():
+            if isinstance(value, list):
+                merged[key] = _merge_outputs(merged.get(key, []), value)
+            elif key not in merged or merged[key] == value:
+                merged[key] = value
+            elif value:
+                merged[key] = f"{merged[key]}\n\n{value}" if merged[key] else value
+    return merged
+
+
+def _resolve_target(binding):
+    """
+    The SSH target of a binding, built from the current Host row, as
+    (target, error). Bindings for hosts that were not found are looked up
+    again, in case the host has been added since the plan was compiled.
+    """
+    if binding.host_id is None:
+        host = host_resolver.resolve(binding.host_name) if binding.host_name else None
+        return (target_for_host(host), None) if host is not None else (None, binding.error)
+    host = db.session.get(Host, binding.host_id)
+    if host is None:
+        return None, f"Host '{binding.host_name}' no longer exists."
+    return target_for_host(host), None
+
+
+def _label_context(context, host_name):
+    """Prefixes a host's results with its name before they are reduced with other hosts'."""
+    return {key: f"[{host_name}]\n{value}" if value and isinstance(value, str) and key != 'last_script' else value
+            for key, value in context.items()}
+
+
+def _script_results(context, field='output'):
+    """
+    The output (or errors) of every script that ran upstream, in execution
+    order, each under a header naming the script and its host. Contexts
+    checkpointed before results were accumulated fall back to the last script's.
+    """
+    entries = context.get('script_outputs')
+    if entries is None:
+        return context.get(f'last_{field}', '')
+    label = 'Output of' if field == 'output' else 'Error from'
+    sections = []
+    for entry in entries:
+        if entry.get(field):
+            host = f" on {entry['host_name']}" if entry.get('host_name') else ''
+            sections.append(f"--- {label} '{entry['name']}'{host} ---\n{entry[field]}")
+    return '\n'.join(sections)
+
+
+def _execute_steps(run):
+    """
+    Runs every step as soon as all of its predecessors have finished, so
+    independent branches execute concurrently. Total parallelism is capped by
+    PIPELINE_MAX_PARALLEL_STEPS and per-host parallelism by
+    PIPELINE_MAX_STEPS_PER_HOST; a matrix run also caps how many hosts are in
+    progress at once. All database writes stay on this thread; worker
+    threads only do the remote work.
+
+    Steps are keyed by (node_id, host_id), see _step_graph. Steps that are
+    already succeeded when the run starts were reused from an earlier run;
+    their checkpointed context is handed on without executing them again.
+    """
+    pipeline = run.pipeline
+    options = run.get_options()
+    app = current_app._get_current_object()
+    max_parallel = app.config.get('PIPELINE_MAX_PARALLEL_STEPS', 8)
+    max_per_host = app.config.get('PIPELINE_MAX_STEPS_PER_HOST', 2)
+    max_hosts = max(1, min(int(options.get('max_parallel_hosts') or max_parallel),
+                           app.config.get('PIPELINE_MATRIX_MAX_HOSTS', 8)))
+
+    plan = plan_cache.get(pipeline)
+    nodes = plan.nodes
+    app_config = {s.key: s.value for s in Setting.query.all()}
+
+    # The definition may have changed since the run was queued; steps whose
+    # node is gone fail on their own, and edges to them are dropped.
+    steps = {(step.node_id, step.host_id): step for step in run.steps}
+    preds, succs = _step_graph(plan, steps)
+
+    # A run may pin every script to one host (e.g. the host a Zabbix alert
+    # came from); otherwise the bindings compiled into the plan are used.
+    bindings = dict(plan.bindings)
+    override_host = Host.query.get(options['host_id']) if options.get('host_id') else None
+    if override_host is not None:
+        pinned = HostBinding.for_host(override_host)
+        bindings = {node_id: pinned for node_id in plan.bindings}
+    matrix_ids = {host_id for _, host_id in steps if host_id is not None}
+    matrix_bindings = {h.id: HostBinding.for_host(h) for h in Host.query.filter(Host.id.in_(matrix_ids)).all()} if matrix_ids else {}
+
+    def binding_for(key):
+        node_id, host_id = key
+        if host_id is None or node_id not in plan.bindings:
+            return bindings.get(node_id)
+        return matrix_bindings.get(host_id) or HostBinding(error=f"Host '{steps[key].host_name}' no longer exists.")
+
+    def parent_context(key):
+        contexts_in = []
+        for pred in preds[key]:
+            context = contexts[pred]
+            if key[1] is None and pred[1] is not None:
+                context = _label_context(context, steps[pred].host_name)
+            contexts_in.append(context)
+        return _merge_contexts(contexts_in)
+
+    contexts = {}
+    remaining = {key: len(p) for key, p in preds.items()}
+    ready = deque()
+    running = {}
+    host_load = {}
+    # Matrix hosts with steps in flight; bounded by max_hosts
+    active_hosts = {}
+
+    def host_of(key):
+        binding = binding_for(key)
+        return binding.host_id if binding is not None else None
+
+    stop_on_script_failure = options.get('stop_on_script_failure', False)
+
+    def release(key):
+        newly_ready = []
+        for succ in succs[key]:
+            remaining[succ] -= 1
+            if remaining[succ] == 0 and steps[succ].status == 'pending':
+                newly_ready.append(succ)
+        if newly_ready:
+            merged = sorted([*ready, *newly_ready], key=lambda k: steps[k].position)
+            ready.clear()
+            ready.extend(merged)
+
+    def complete(key, result):
+        step = steps[key]
+        contexts[key] = {**parent_context(key), **result.get('context', {})}
+        if step.step_type == 'script':
+            # Every script's result is handed on, so reports cover the whole run and not just the last script
+            binding = binding_for(key)
+            entry = {'node_id': key[0], 'host_id': key[1], 'position': step.position, 'name': step.step_name,
+                     'host_name': step.host_name or (binding.host_name if binding is not None else None),
+                     'output': result.get('output', ''), 'error': result.get('error', '')}
+            contexts[key]['script_outputs'] = _merge_outputs(contexts[key].get('script_outputs', []), [entry])
+        _finish_step(step, result['success'], result.get('output', ''), result.get('error', ''),
+                     result.get('output_url'), result.get('error_url'), contexts[key], result.get('tokens'))
+        if stop_on_script_failure and step.step_type == 'script' and not result['success']:
+            # Start nothing new for this host (or for the whole run outside a
+            # matrix); in-flight steps are left to finish.
+            for other_key, other in steps.items():
+                if other.status == 'pending' and (key[1] is None or other_key[1] == key[1]):
+                    other.status = 'skipped'
+            db.session.commit()
+            for other_key, other in steps.items():
+                if other.status == 'skipped' and other_key not in contexts:
+                    contexts[other_key] = {}
+                    release(other_key)
+        release(key)
+
+    for key in sorted(steps, key=lambda k: steps[k].position):
+        if steps[key].status == 'succeeded':
+            contexts[key] = steps[key].get_context()
+            release(key)
+    ready.clear()
+    ready.extend(key for key in sorted(steps, key=lambda k: steps[k].position)
+                 if remaining[key] == 0 and steps[key].status == 'pending')
+
+    while ready or running:
+        deferred = []
+        while ready and len(running) < max_parallel:
+            key = ready.popleft()
+            step = steps[key]
+            if step.status != 'pending':
+                continue
+            node = nodes.get(key[0])
+            host_id = host_of(key)
+            if host_id is not None and host_load.get(host_id, 0) >= max_per_host:
+                deferred.append(key)
+                continue
+            if key[1] is not None and key[1] not in active_hosts and len(active_hosts) >= max_hosts:
+                deferred.append(key)
+                continue
+
+            step.status = 'running'
+            step.started_at = datetime.utcnow()
+            db.session.commit()
+
+            if node is None:
+                complete(key, {'success': False, 'error': 'Node no longer exists in the pipeline definition.'})
+                continue
+            binding = binding_for(key)
+            target, error = _resolve_target(binding) if binding is not None else (None, None)
+            if error:
+                complete(key, {'success': False, 'error': error})
+                continue
+
+            work = {
+                'node': node,
+                'target': target,
+                'context': parent_context(key),
+                'options': options,
+                'app_config': app_config,
+                'pipeline_name': pipeline.name,
+            }
+            future = host_executor.submit(_run_in_context, app, work)
+            running[future] = key
+            if host_id is not None:
+                host_load[host_id] = host_load.get(host_id, 0) + 1
+            if key[1] is not None:
+                active_hosts[key[1]] = active_hosts.get(key[1], 0) + 1
+        ready.extendleft(reversed(deferred))
+
+        if not running:
+            if deferred:
+                # Only reachable if limits are misconfigured to zero
+                raise RuntimeError('Pipeline run cannot make progress with the configured concurrency limits.')
+            continue
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            key = running.pop(future)
+            host_id = host_of(key)
+            if host_id is not None:
+                host_load[host_id] -= 1
+            if key[1] is not None:
+                active_hosts[key[1]] -= 1
+                if not active_hosts[key[1]]:
+                    del active_hosts[key[1]]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {'success': False, 'error': str(e)}
+            complete(key, result)
+
+
+def _run_in_context(app, work):
+    with app.app_context():
+        return _run_step(**work)
+
+
+def _run_step(node, target, context, options, app_config, pipeline_name):
+    """
+    Executes a single node and returns its result. Runs on a worker thread and
+    must not write to the database. The returned 'context' is merged into
+    what downstream nodes see.
+    """
+    step_type = node['type']
+
+    if step_type == 'script':
+        script_content = node.get('content')
+        if not script_content:
+            return {'success': True, 'output': 'No script content to run.'}
+
+        try:
+            sanitized_script = script_content.replace("'", "'\\''")
+            command = f"sudo bash -c '{sanitized_script}'" if options.get('use_sudo', False) else f"bash -c '{sanitized_script}'"
+            stdout, stderr, exit_code = ssh_pool.exec_command(target, command)
+            output, error = str(stdout), str(stderr)
+            return {
+                'success': exit_code == 0, 'output': output, 'error': error,
+                'output_url': stdout.download_url(), 'error_url': stderr.download_url(),
+                'context': {'last_script': script_content, 'last_output': output, 'last_error': error},
+            }
+        except Exception as e:
+            return {'success': False, 'error': str(e), 'context': {'last_script': script_content, 'last_error': str(e)}}
+
+    if step_type != 'action':
+        return {'success': True, 'output': f"Step type '{step_type}' has nothing to execute."}
+
+    trigger = options.get('trigger')
+
+    if node['name'] == 'AI Analysis':
+        prompt = f"Analyze the output of the previous script. Provide a summary, breakdown, and troubleshooting suggestions.\n\nScript:\n```\n{context.get('last_script', 'N/A')}\n```"
+        if _is_reduced(node, options):
+            prompt = f"The same pipeline ran on several hosts; each result below is labelled with its host. Compare the hosts and call out any that differ.\n\n{prompt}"
+        if trigger:
+            prompt = f"A Zabbix alert named '{trigger['trigger_name']}' occurred on host '{trigger['hostname']}'. The following diagnostic data was collected.\n\n{prompt}"
+        data = f"Output:\n```\n{_script_results(context)}\n```\n\nError:\n```\n{_script_results(context, 'error')}\n```"
+        analysis = _get_ai_analysis(lambda data: f"{prompt}\n\n{data}", data, options.get('ai_provider'), app_config)
+        tokens = {k: analysis[k] for k in ('tokens_sent', 'tokens_before', 'tokens_after') if k in analysis}
+        if tokens:
+            current_app.logger.info(f"AI analysis: data compacted from about {tokens['tokens_before']} to {tokens['tokens_after']} "
+                                    f"tokens, {tokens['tokens_sent']} tokens sent in {analysis['chunks'] or 1} part(s).")
+        return {'success': not analysis.get('error'), 'output': analysis.get('output', ''), 'error': analysis.get('error', ''),
+                'tokens': tokens, 'context': {'last_analysis': analysis.get('output', '')}}
+
+    if node['name'] == 'Notify Discord':
+        webhook_url = app_config.get('discord_webhook')
+        if not webhook_url:
+            return {'success': False, 'error': 'Discord webhook not configured.'}
+
+        if trigger:
+            message = (
+                f"**Zabbix Alert Triage Report**\n"
+                f"**Host:** `{trigger['hostname']}`\n"
+                f"**Trigger:** `{trigger['trigger_name']}`\n"
+                f"**Pipeline:** `{pipeline_name}`\n"
+                f"----------------------------------------\n"
+                f"**AI Synopsis & Recommendations:**\n"
+                f"```\n{context.get('last_analysis', 'N/A')}\n```\n"
+                f"----------------------------------------\n"
+                f"**Raw Diagnostic Output:**\n"
+                f"```\n{_script_results(context) or 'No output.'}\n```"
+            )
+        else:
+            message = (f"**Pipeline Execution Report**\n\n"
+                       f"**Last Script:**\n```bash\n{context.get('last_script', 'N/A')}\n```\n"
+                       f"**Output:**\n```\n{_script_results(context) or 'N/A'}\n```\n"
+                       f"**AI Analysis:**\n{context.get('last_analysis', 'N/A')}")
+        success, status = send_to_discord(webhook_url, message)
+        return {'success': success, 'output': status if success else '', 'error': '' if success else status}
+
+    if node['name'] == 'Send Email':
+        recipient = node.get('data', {}).get('recipient', options.get('default_recipient'))
+        subject = f"Fysseree AIOps Pipeline Report: {pipeline_name}"
+
+        # Get the analysis and perform the replace operation *before* the f-string.
+        ai_analysis = context.get('last_analysis', 'N/A')
+        formatted_analysis = ai_analysis.replace('\n', '<br>')
+
+        body = f"""
+        <html><body>
+        <h2>Pipeline Execution Report</h2>
+        <p><strong>Pipeline:</strong> {pipeline_name}</p>
+        <hr>
+        <h3>Last Script Executed:</h3>
+        <pre><code>{context.get('last_script', 'N/A')}</code></pre>
+        <h3>Output:</h3>
+        <pre><code>{_script_results(context) or 'N/A'}</code></pre>
+        <h3>Error:</h3>
+        <pre><code>{_script_results(context, 'error') or 'N/A'}</code></pre>
+        <h3>AI Analysis:</h3>
+        <p>{formatted_analysis}</p> </body></html>
+        """
+        success, message = send_email(recipient, subject, body)
+        return {'success': success, 'output': message, 'error': '' if success else message}
+
+    return {'success': True, 'output': 'Unknown action; nothing to do.'}
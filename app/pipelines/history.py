@@ -0,0 +1,118 @@
+"""
+Pipeline run history.
+
+Every run, whatever started it, is recorded as an append-only PipelineRun
+with its StepRuns. This module filters that history, prunes it after
+``RUN_HISTORY_RETENTION_DAYS`` and computes per-pipeline duration
+percentiles and failure rates.
+"""
+import logging
+import math
+import threading
+import time
+from datetime import datetime, timedelta
+
+from app import db
+from app.models import PipelineRun, StepRun
+
+logger = logging.getLogger(__name__)
+
+FILTERS = ('pipeline_id', 'status', 'trigger_source', 'host_id', 'scheduled_job_id')
+
+
+def filter_runs(args):
+    """Returns a newest-first PipelineRun query filtered by the FILTERS keys present in ``args``."""
+    query = PipelineRun.query
+    for field in FILTERS:
+        value = args.get(field)
+        if value not in (None, ''):
+            query = query.filter(getattr(PipelineRun, field) == value)
+    return query.order_by(PipelineRun.created_at.desc(), PipelineRun.id.desc())
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list, or None when it is empty."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def pipeline_stats(days=7, pipeline_id=None):
+    """
+    Per-pipeline run count, failure rate and p50/p95 duration over finished
+    runs from the last ``days`` days, slowest (by p95) first.
+    """
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    query = db.session.query(
+        PipelineRun.pipeline_id, PipelineRun.pipeline_name, PipelineRun.status, PipelineRun.started_at, PipelineRun.finished_at,
+    ).filter(
+        PipelineRun.created_at >= cutoff,
+        PipelineRun.status.in_(('succeeded', 'failed')),
+    )
+    if pipeline_id:
+        query = query.filter(PipelineRun.pipeline_id == pipeline_id)
+
+    grouped = {}
+    for pid, name, status, started_at, finished_at in query:
+        # Runs of deleted pipelines have no ID left; they are grouped by name
+        entry = grouped.setdefault((pid, name), {'pipeline_id': pid, 'pipeline_name': name, 'runs': 0, 'failed': 0, 'durations': []})
+        entry['runs'] += 1
+        entry['failed'] += status == 'failed'
+        if started_at and finished_at:
+            entry['durations'].append(round((finished_at - started_at).total_seconds() * 1000))
+
+    stats = []
+    for entry in grouped.values():
+        durations = sorted(entry.pop('durations'))
+        entry['failure_rate'] = round(entry['failed'] / entry['runs'], 4)
+        entry['p50_ms'] = percentile(durations, 50)
+        entry['p95_ms'] = percentile(durations, 95)
+        stats.append(entry)
+    stats.sort(key=lambda e: e['p95_ms'] or 0, reverse=True)
+    return stats
+
+
+class RunHistory:
+    """Applies the run-history retention period."""
+
+    def __init__(self, retention_days=30):
+        self.retention_days = retention_days
+        self._last_prune = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.retention_days = app.config.get('RUN_HISTORY_RETENTION_DAYS', self.retention_days)
+
+    def prune(self, force=False):
+        """
+        Deletes finished runs (and their steps) older than the retention period,
+        at most once an hour unless forced. Must be called inside an app context.
+        Returns the number of runs deleted.
+        """
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_prune < 3600:
+                return 0
+            self._last_prune = now
+        cutoff = datetime.utcnow() - timedelta(days=self.retention_days)
+        deleted = 0
+        try:
+            # Batches keep each transaction (and lock) short on large histories
+            while True:
+                ids = [run_id for (run_id,) in db.session.query(PipelineRun.id).filter(
+                    PipelineRun.created_at < cutoff,
+                    PipelineRun.status.in_(('succeeded', 'failed')),
+                ).limit(1000)]
+                if not ids:
+                    return deleted
+                StepRun.query.filter(StepRun.run_id.in_(ids)).delete(synchronize_session=False)
+                deleted += PipelineRun.query.filter(PipelineRun.id.in_(ids)).delete(synchronize_session=False)
+                db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Could not prune pipeline run history: {e}")
+            return deleted
+
+
+run_history = RunHistory()
@@ -0,0 +1,207 @@
+"""
+Compiled pipeline execution plans.
+
+Compiling a pipeline parses its JSON definition once, orders its nodes, groups
+them into stages, indexes the edges in both directions and resolves every
+script node's host to a database ID. Plans are cached by a hash of the
+definition, so repeat and scheduled runs of an unchanged pipeline skip all of
+that work.
+
+Plans hold host IDs only, never addresses or credentials: the engine reads
+the current Host row when a step starts, so host edits made in any process
+apply to the next step. Saving a pipeline or changing a host in this process
+also drops the cached plans.
+"""
+from collections import OrderedDict, deque
+import hashlib
+import json
+import threading
+
+from app.host_resolver import host_resolver
+
+
+class PipelineCycleError(Exception):
+    """Raised when a pipeline graph cannot be ordered because it contains a cycle."""
+
+
+def dependency_graph(nodes, connections):
+    """
+    Returns {node_id: set of predecessor node_ids} for every executable
+    (non-host) node. Explicit connections are used as drawn. An action node
+    with no incoming connections implicitly waits for every script (and, for
+    notifications, every AI Analysis) node that is not downstream of it, so
+    loosely wired pipelines still report on everything that ran.
+    """
+    preds = {node_id: set() for node_id, node in nodes.items() if node.get('type') != 'host'}
+    succs = {node_id: set() for node_id in preds}
+    for conn in connections:
+        if conn['from'] in preds and conn['to'] in preds:
+            preds[conn['to']].add(conn['from'])
+            succs[conn['from']].add(conn['to'])
+
+    def descendants(node_id):
+        seen, stack = set(), [node_id]
+        while stack:
+            for succ in succs[stack.pop()]:
+                if succ not in seen:
+                    seen.add(succ)
+                    stack.append(succ)
+        return seen
+
+    scripts = [nid for nid in preds if nodes[nid].get('type') == 'script']
+    analyses = [nid for nid in preds if nodes[nid].get('type') == 'action' and nodes[nid].get('name') == 'AI Analysis']
+    unwired = [nid for nid in preds if nodes[nid].get('type') == 'action' and not preds[nid]]
+    # AI Analysis nodes first, so notifications can in turn wait for them
+    unwired.sort(key=lambda nid: nid not in analyses)
+    for node_id in unwired:
+        sources = scripts if node_id in analyses else scripts + analyses
+        downstream = descendants(node_id)
+        for source in sources:
+            if source != node_id and source not in downstream:
+                preds[node_id].add(source)
+                succs[source].add(node_id)
+    return preds
+
+
+def topological_order(preds):
+    """Returns node IDs in dependency order (Kahn's algorithm), ties kept in definition order."""
+    in_degree = {node_id: len(p) for node_id, p in preds.items()}
+    adj = {node_id: [] for node_id in preds}
+    for node_id, p in preds.items():
+        for pred in p:
+            adj[pred].append(node_id)
+
+    queue = deque(node_id for node_id in preds if in_degree[node_id] == 0)
+    sorted_order = []
+    while queue:
+        node_id = queue.popleft()
+        sorted_order.append(node_id)
+        for neighbor_id in adj[node_id]:
+            in_degree[neighbor_id] -= 1
+            if in_degree[neighbor_id] == 0:
+                queue.append(neighbor_id)
+
+    if len(sorted_order) != len(preds):
+        raise PipelineCycleError('Pipeline has a cycle and cannot be run.')
+    return sorted_order
+
+
+def definition_hash(definition):
+    return hashlib.sha256((definition or '').encode('utf-8')).hexdigest()
+
+
+class HostBinding:
+    """
+    The host a script node runs on, or the reason it has none. A host that
+    was not found keeps the name it was looked up by, so it can be resolved
+    again when it is added later.
+    """
+
+    __slots__ = ('host_id', 'host_name', 'error')
+
+    def __init__(self, host_id=None, host_name=None, error=None):
+        self.host_id = host_id
+        self.host_name = host_name
+        self.error = error
+
+    @classmethod
+    def for_host(cls, host):
+        return cls(host.id, host.name)
+
+
+class ExecutionPlan:
+    """An immutable, pre-analysed view of one pipeline definition."""
+
+    def __init__(self, definition):
+        self.definition_hash = definition_hash(definition)
+        graph = json.loads(definition)
+        self.nodes = graph['nodes']
+        connections = graph['connections']
+
+        graph_preds = dependency_graph(self.nodes, connections)
+        self.order = tuple(topological_order(graph_preds))
+        self.position = {node_id: i for i, node_id in enumerate(self.order)}
+        # Predecessors are kept in execution order so context merging is deterministic.
+        self.preds = {node_id: tuple(sorted(graph_preds[node_id], key=self.position.get)) for node_id in self.order}
+        succs = {node_id: [] for node_id in self.order}
+        for node_id in self.order:
+            for pred in self.preds[node_id]:
+                succs[pred].append(node_id)
+        self.succs = {node_id: tuple(s) for node_id, s in succs.items()}
+
+        level = {}
+        for node_id in self.order:
+            level[node_id] = max((level[p] + 1 for p in self.preds[node_id]), default=0)
+        stages = [[] for _ in range(max(level.values(), default=-1) + 1)]
+        for node_id in self.order:
+            stages[level[node_id]].append(node_id)
+        self.stages = tuple(tuple(stage) for stage in stages)
+
+        self.bindings = self._bind_hosts(connections)
+
+    def _bind_hosts(self, connections):
+        """Resolves every script node's host node to a Host row by name, alias or IP address, in one lookup."""
+        host_node_for = {}
+        for conn in connections:
+            if self.nodes.get(conn['from'], {}).get('type') == 'host' and conn['to'] not in host_node_for:
+                host_node_for[conn['to']] = conn['from']
+        default_host_node_id = next((nid for nid, n in self.nodes.items() if n.get('type') == 'host'), None)
+
+        wanted = {}
+        for node_id in self.order:
+            if self.nodes[node_id]['type'] == 'script':
+                wanted[node_id] = host_node_for.get(node_id, default_host_node_id)
+
+        names = {self.nodes[host_node_id]['name'] for host_node_id in wanted.values() if host_node_id}
+        hosts = host_resolver.resolve_many(names)
+
+        bindings = {}
+        for node_id, host_node_id in wanted.items():
+            if not host_node_id:
+                bindings[node_id] = HostBinding(error='No host connected to this script, and no default host found in pipeline.')
+                continue
+            name = self.nodes[host_node_id]['name']
+            host = hosts.get(name)
+            if host is None:
+                bindings[node_id] = HostBinding(host_name=name, error=f"Host '{name}' not found in database.")
+                continue
+            bindings[node_id] = HostBinding.for_host(host)
+        return bindings
+
+
+class PlanCache:
+    """A thread-safe LRU of compiled plans keyed by definition hash."""
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.max_size = app.config.get('PIPELINE_PLAN_CACHE_SIZE', self.max_size)
+
+    def get(self, pipeline):
+        """Returns the compiled plan for a pipeline, compiling it on a cache miss."""
+        key = definition_hash(pipeline.definition)
+        with self._lock:
+            plan = self._plans.get(key)
+            if plan is not None:
+                self._plans.move_to_end(key)
+                return plan
+        plan = ExecutionPlan(pipeline.definition)
+        with self._lock:
+            self._plans[key] = plan
+            while len(self._plans) > self.max_size:
+                self._plans.popitem(last=False)
+        return plan
+
+    def invalidate(self):
+        """
+        Drops every plan, for host changes that alter host bindings. Edited
+        pipelines need no invalidation: a new definition has a new hash.
+        """
+        with self._lock:
+            self._plans.clear()
+
+
+plan_cache = PlanCache()
@@ -2,44 +2,23 @@ from flask import render_template, flash, request, jsonify, redirect, url_for
 from flask_login import current_user, login_required
 from . import bp
 from app import db
-from app.models import Host, Script, Pipeline, Setting
-from app.utils import get_repo_scripts_recursive, get_script_icon
+from app.models import Host, Group, Script, Pipeline, PipelineRun, Setting
+from app.utils import get_repo_scripts_recursive, get_script_icon, sse_response
+from app.ai import ai_clients
+from app.pipelines.engine import create_run, create_resume_run, matrix_hosts, ResumeError
+from app.pipelines.history import filter_runs, pipeline_stats
+from app.pipelines.plan import PipelineCycleError
+from app.pipelines.runner import pipeline_runner, RunQueueFull
 from github import Github, UnknownObjectException
 import yaml
-import paramiko
 import json
-import google.generativeai as genai
-import openai
-import requests
-from app.notifications import send_email # Import the new send_email function
-
-def _get_ai_analysis(prompt_text, ai_provider=None):
-    """Helper function to get analysis from the configured AI provider."""
-    settings_list = Setting.query.all()
-    app_config = {s.key: s.value for s in settings_list}
-    
-    if not ai_provider:
-        ai_provider = app_config.get('ai_provider', 'gemini')
-    
-    api_key = app_config.get(f'{ai_provider}_api_key')
-    if not api_key: return {"error": f"{ai_provider.capitalize()} API key not configured."}
-    try:
-        if ai_provider == 'gemini':
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel('gemini-1.5-flash')
-            response = model.generate_content(prompt_text)
-            return {"output": response.text}
-        else: # ChatGPT
-            client = openai.OpenAI(api_key=api_key)
-            response = client.chat.completions.create(model="gpt-3.5-turbo", messages=[{"role": "user", "content": prompt_text}])
-            return {"output": response.choices[0].message.content}
-    except Exception as e:
-        return {"error": str(e)}
+import time
 
 @bp.route('/')
 @login_required
 def pipeline_canvas():
     hosts = Host.query.order_by(Host.name).all()
+    host_groups = Group.query.filter(Group.id.in_(db.session.query(Host.group_id))).order_by(Group.name).all()
     local_scripts = Script.query.order_by(Script.name).all()
     
     # Fetch and format saved pipelines to include ID in the name
@@ -99,7 +78,7 @@ def pipeline_canvas():
         'email': bool(app_config.get('smtp_server')) 
     }
 
-    return render_template('pipelines/pipelines.html', title='Pipeline Builder', hosts=hosts, local_scripts=local_scripts, github_scripts=github_scripts, saved_pipelines=saved_pipelines, github_pipelines=github_pipelines, notifications=notifications)
+    return render_template('pipelines/pipelines.html', title='Pipeline Builder', hosts=hosts, local_scripts=local_scripts, github_scripts=github_scripts, saved_pipelines=saved_pipelines, github_pipelines=github_pipelines, notifications=notifications, host_groups=host_groups)
 
 @bp.route('/save', methods=['POST'])
 @login_required
@@ -133,147 +112,131 @@ def save_pipeline():
 @bp.route('/run/<int:pipeline_id>', methods=['POST'])
 @login_required
 def run_pipeline(pipeline_id):
-    data = request.get_json()
-    use_sudo = data.get('use_sudo', False)
-    ai_provider = data.get('ai_provider', 'gemini')
-    
+    """
+    Queues a pipeline run and returns its ID straight away; execution happens in the background.
+    Passing 'group_id' or 'host_ids' makes it a matrix run over those hosts.
+    """
+    data = request.get_json() or {}
     pipeline = Pipeline.query.get_or_404(pipeline_id)
-    graph = json.loads(pipeline.definition)
-    nodes = graph['nodes']
-    connections = graph['connections']
-
-    # --- Topological Sort to get correct execution order ---
-    in_degree = {node_id: 0 for node_id in nodes}
-    adj = {node_id: [] for node_id in nodes}
-    for conn in connections:
-        if conn['from'] in adj and conn['to'] in in_degree:
-            adj[conn['from']].append(conn['to'])
-            in_degree[conn['to']] += 1
-    
-    queue = [node_id for node_id in nodes if in_degree[node_id] == 0]
-    sorted_order = []
-    while queue:
-        node_id = queue.pop(0)
-        sorted_order.append(node_id)
-        for neighbor_id in adj.get(node_id, []):
-            in_degree[neighbor_id] -= 1
-            if in_degree[neighbor_id] == 0:
-                queue.append(neighbor_id)
-    
-    if len(sorted_order) != len(nodes):
-        return jsonify({'results': [{'step_name': 'Pipeline Error', 'success': False, 'output': '', 'error': 'Pipeline has a cycle and cannot be run.'}]}), 400
-    # --- End Topological Sort ---
+    options = {
+        'use_sudo': data.get('use_sudo', False),
+        'ai_provider': data.get('ai_provider', 'gemini'),
+        'default_recipient': current_user.email,
+    }
 
-    execution_results = []
-    context = {} 
-    
-    default_host_node_id = next((nid for nid, n in nodes.items() if n.get('type') == 'host'), None)
-    default_host_node = nodes.get(default_host_node_id) if default_host_node_id else None
+    hosts = None
+    if data.get('group_id') or data.get('host_ids'):
+        try:
+            hosts = matrix_hosts(data.get('group_id'), data.get('host_ids'))
+            if data.get('max_parallel_hosts'):
+                options['max_parallel_hosts'] = int(data['max_parallel_hosts'])
+        except (TypeError, ValueError):
+            return jsonify({'error': 'host_ids and max_parallel_hosts must be integers.'}), 400
+        if not hosts:
+            return jsonify({'error': 'No hosts found to run the pipeline on.'}), 400
+        options['matrix'] = {'reduce': bool(data.get('reduce', False))}
 
-    for node_id in sorted_order:
-        node = nodes[node_id]
-        step_name = node['name']
-        step_type = node['type']
-        
-        if step_type == 'host':
-            continue
-
-        if step_type == 'script':
-            explicit_connection = next((c for c in connections if c['to'] == node_id and nodes.get(c['from'], {}).get('type') == 'host'), None)
-            host_node = nodes.get(explicit_connection['from']) if explicit_connection else default_host_node
-
-            if not host_node:
-                execution_results.append({'step_name': step_name, 'success': False, 'output': '', 'error': 'No host connected to this script, and no default host found in pipeline.'})
-                continue
-            
-            target_host = Host.query.filter_by(name=host_node['name']).first()
-            if not target_host:
-                execution_results.append({'step_name': step_name, 'success': False, 'output': '', 'error': f"Host '{host_node['name']}' not found in database."})
-                continue
-
-            script_content = node.get('content')
-            if not script_content:
-                execution_results.append({'step_name': step_name, 'success': True, 'output': 'No script content to run.', 'error': ''})
-                continue
-            
-            context['last_script'] = script_content
-            
-            try:
-                sanitized_script = script_content.replace("'", "'\\''")
-                command = f"sudo bash -c '{sanitized_script}'" if use_sudo else f"bash -c '{sanitized_script}'"
-                
-                client = paramiko.SSHClient()
-                client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                client.connect(hostname=target_host.ip_address, username=target_host.ssh_user, look_for_keys=True, timeout=10)
-                
-                stdin, stdout, stderr = client.exec_command(command)
-                output = stdout.read().decode('utf-8')
-                error = stderr.read().decode('utf-8')
-                exit_code = stdout.channel.recv_exit_status()
-                client.close()
-                
-                context['last_output'] = output
-                context['last_error'] = error
-                execution_results.append({'step_name': step_name, 'success': exit_code == 0, 'output': output, 'error': error})
-            except Exception as e:
-                context['last_error'] = str(e)
-                execution_results.append({'step_name': step_name, 'success': False, 'output': '', 'error': str(e)})
-
-        elif step_type == 'action':
-            if node['name'] == 'AI Analysis':
-                prompt = f"Analyze the output of the previous script. Provide a summary, breakdown, and troubleshooting suggestions.\n\nScript:\n```\n{context.get('last_script', 'N/A')}\n```\n\nOutput:\n```\n{context.get('last_output', '')}\n```\n\nError:\n```\n{context.get('last_error', '')}\n```"
-                analysis = _get_ai_analysis(prompt, ai_provider)
-                context['last_analysis'] = analysis.get('output', '')
-                execution_results.append({'step_name': step_name, 'success': not analysis.get('error'), 'output': analysis.get('output', ''), 'error': analysis.get('error', '')})
-            
-            elif node['name'] == 'Notify Discord':
-                settings_list = Setting.query.all()
-                app_config = {s.key: s.value for s in settings_list}
-                webhook_url = app_config.get('discord_webhook')
-                if not webhook_url:
-                    execution_results.append({'step_name': step_name, 'success': False, 'output': '', 'error': 'Discord webhook not configured.'})
-                    continue
-                
-                message = (f"**Pipeline Execution Report**\n\n"
-                           f"**Last Script:**\n```bash\n{context.get('last_script', 'N/A')}\n```\n"
-                           f"**Output:**\n```\n{context.get('last_output', 'N/A')}\n```\n"
-                           f"**AI Analysis:**\n{context.get('last_analysis', 'N/A')}")
-                
-                try:
-                    requests.post(webhook_url, json={'content': message[:2000]}, timeout=5)
-                    execution_results.append({'step_name': step_name, 'success': True, 'output': 'Discord notification sent.', 'error': ''})
-                except Exception as e:
-                    execution_results.append({'step_name': step_name, 'success': False, 'output': '', 'error': str(e)})
-            
-            elif node['name'] == 'Send Email':
-                recipient = node.get('data', {}).get('recipient', current_user.email)
-                subject = f"Fysseree AIOps Pipeline Report: {pipeline.name}"
-
-                # --- FIX START ---
-                # Get the analysis and perform the replace operation *before* the f-string.
-                ai_analysis = context.get('last_analysis', 'N/A')
-                formatted_analysis = ai_analysis.replace('\n', '<br>')
-                # --- FIX END ---
-
-                body = f"""
-                <html><body>
-                <h2>Pipeline Execution Report</h2>
-                <p><strong>Pipeline:</strong> {pipeline.name}</p>
-                <hr>
-                <h3>Last Script Executed:</h3>
-                <pre><code>{context.get('last_script', 'N/A')}</code></pre>
-                <h3>Output:</h3>
-                <pre><code>{context.get('last_output', 'N/A')}</code></pre>
-                <h3>Error:</h3>
-                <pre><code>{context.get('last_error', 'N/A')}</code></pre>
-                <h3>AI Analysis:</h3>
-                <p>{formatted_analysis}</p> </body></html>
-                """
-                success, message = send_email(recipient, subject, body)
-                execution_results.append({'step_name': step_name, 'success': success, 'output': message, 'error': '' if success else message})
+    try:
+        run = create_run(pipeline, options, trigger_source='manual', hosts=hosts)
+    except PipelineCycleError as e:
+        return jsonify({'results': [{'step_name': 'Pipeline Error', 'success': False, 'output': '', 'error': str(e)}]}), 400
 
-    
-    return jsonify({'results': execution_results})
+    return _enqueue(run)
+
+def _enqueue(run):
+    try:
+        pipeline_runner.enqueue(run)
+    except RunQueueFull as e:
+        return jsonify({'run_id': run.id, 'status': run.status, 'error': str(e)}), 429
+    return jsonify({
+        'run_id': run.id,
+        'status': run.status,
+        'status_url': url_for('pipelines.run_status', run_id=run.id),
+        'events_url': url_for('pipelines.run_events', run_id=run.id),
+    }), 202
+
+@bp.route('/runs/<int:run_id>/resume', methods=['POST'])
+@login_required
+def resume_run(run_id):
+    """
+    Queues a new run that reuses the stored results of a finished one. Reruns the
+    steps that did not succeed, or 'node_id' and everything downstream of it.
+    """
+    data = request.get_json(silent=True) or {}
+    source = PipelineRun.query.get_or_404(run_id)
+    try:
+        run = create_resume_run(source, data.get('node_id'))
+    except (ResumeError, PipelineCycleError) as e:
+        return jsonify({'error': str(e)}), 409
+
+    return _enqueue(run)
+
+@bp.route('/queue', methods=['GET'])
+@login_required
+def queue_stats():
+    """Returns the run queue depth per priority, busy workers, rejections and recent queue wait times."""
+    return jsonify(pipeline_runner.stats())
+
+@bp.route('/history', methods=['GET'])
+@login_required
+def history_page():
+    """Shows recent runs of every pipeline, filterable, with per-pipeline duration and failure stats."""
+    page = request.args.get('page', 1, type=int)
+    days = request.args.get('days', 7, type=int)
+    pagination = filter_runs(request.args).paginate(page=page, per_page=50, error_out=False)
+    stats = pipeline_stats(days, request.args.get('pipeline_id', type=int))
+    pipelines = Pipeline.query.order_by(Pipeline.name).all()
+    filters = {k: v for k, v in request.args.items() if k != 'page' and v}
+    return render_template('pipelines/history.html', title='Run History', runs=pagination.items, pagination=pagination,
+                           stats=stats, days=days, pipelines=pipelines, filters=filters)
+
+@bp.route('/runs', methods=['GET'])
+@login_required
+def list_runs():
+    """Returns runs newest first, filtered by pipeline_id, status, trigger_source, host_id or scheduled_job_id."""
+    limit = min(request.args.get('limit', 50, type=int), 500)
+    offset = request.args.get('offset', 0, type=int)
+    runs = filter_runs(request.args).offset(offset).limit(limit).all()
+    return jsonify({'runs': [run.to_dict(include_steps=request.args.get('steps') == '1') for run in runs]})
+
+@bp.route('/runs/stats', methods=['GET'])
+@login_required
+def run_stats():
+    """Per-pipeline run count, failure rate and p50/p95 duration over the last 'days' days (default 7)."""
+    days = request.args.get('days', 7, type=int)
+    return jsonify({'days': days, 'pipelines': pipeline_stats(days, request.args.get('pipeline_id', type=int))})
+
+@bp.route('/runs/<int:run_id>', methods=['GET'])
+@login_required
+def run_status(run_id):
+    """Returns the current status, per-step results and timings of a pipeline run."""
+    run = PipelineRun.query.get_or_404(run_id)
+    return jsonify(run.to_dict())
+
+@bp.route('/runs/<int:run_id>/events', methods=['GET'])
+@login_required
+def run_events(run_id):
+    """Streams step and run status changes of a pipeline run as Server-Sent Events."""
+    PipelineRun.query.get_or_404(run_id)
+
+    def generate():
+        seen = {}
+        while True:
+            # Drop cached rows so each poll sees what the worker thread committed
+            db.session.expire_all()
+            run = PipelineRun.query.get(run_id)
+            for step in run.steps:
+                state = (step.status, step.finished_at)
+                if seen.get(step.id) != state:
+                    seen[step.id] = state
+                    yield {'event': 'step', **step.to_dict()}
+            if run.is_finished:
+                yield {'event': 'run', **run.to_dict(include_steps=False)}
+                return
+            db.session.rollback()
+            time.sleep(0.5)
+
+    return sse_response(generate())
 
 @bp.route('/dry-run-yaml', methods=['POST'])
 @login_required
@@ -288,20 +251,8 @@ def dry_run_yaml():
     
     analysis_prompt = f"You are a helpful DevOps assistant. Analyze the following pipeline YAML. Explain what the pipeline does, what each job is responsible for, and point out any potential issues or improvements. Use 'HEADING: ' to mark section titles.\n\nYAML:\n```yaml\n{yaml_content}\n```"
     try:
-        if ai_provider == 'gemini':
-            api_key = app_config.get('gemini_api_key')
-            if not api_key: return jsonify({'error': 'Gemini API key is not configured.'}), 500
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel('gemini-1.5-flash')
-            response = model.generate_content(analysis_prompt)
-            analysis = response.text
-        else:
-            api_key = app_config.get('chatgpt_api_key')
-            if not api_key: return jsonify({'error': 'ChatGPT API key is not configured.'}), 500
-            client = openai.OpenAI(api_key=api_key)
-            response = client.chat.completions.create(model="gpt-3.5-turbo", messages=[{"role": "user", "content": analysis_prompt}])
-            analysis = response.choices[0].message.content
-        return jsonify({'output': analysis})
+        analysis, cached = ai_clients.cached_complete(analysis_prompt, ai_provider, app_config, refresh=data.get('no_cache', False))
+        return jsonify({'output': analysis, 'cached': cached})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
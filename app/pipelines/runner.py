@@ -0,0 +1,264 @@
+"""
+Background worker pool for pipeline runs.
+
+Submitted runs wait in a bounded priority queue and are executed by a small
+pool of worker threads, each inside its own app context, so HTTP requests
+can return a run ID immediately instead of holding the connection open for
+the whole pipeline.
+
+Alert-driven runs jump ahead of manual and scheduled ones, and some capacity
+is held back for them: the last ``PIPELINE_QUEUE_HIGH_PRIORITY_SLOTS`` queue
+slots only accept high-priority runs, and ``PIPELINE_RESERVED_WORKERS`` of
+the workers only pick up high-priority runs. A nightly backlog of cron jobs
+therefore cannot delay incident triage.
+
+The queue lives in process memory, so every run records the process that
+queued it and that process renews the run's heartbeat while it is queued or
+running. The first request served after a restart recovers runs whose
+heartbeat has gone stale: running ones are failed (and can be resumed),
+queued ones are queued again.
+"""
+import heapq
+import itertools
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+HIGH, MEDIUM, LOW = 0, 1, 2
+PRIORITY_NAMES = {HIGH: 'high', MEDIUM: 'medium', LOW: 'low'}
+# Priority of a run by what triggered it
+TRIGGER_PRIORITIES = {'zabbix': HIGH, 'manual': MEDIUM, 'run_now': MEDIUM, 'resume': MEDIUM, 'cron': LOW}
+# A run is abandoned once its heartbeat is this many intervals old
+STALE_HEARTBEATS = 3
+INTERRUPTED_ERRORS = {'queued': 'Interrupted by a restart before it started.',
+                      'running': 'Interrupted by a restart before it finished.'}
+
+
+class RunQueueFull(Exception):
+    """Raised when a run is submitted while the queue has no room for its priority."""
+
+
+class PipelineRunner:
+    """Executes queued PipelineRuns in priority order on a bounded pool of worker threads."""
+
+    def __init__(self, max_workers=4, queue_size=100, high_priority_slots=20, reserved_workers=1,
+                 heartbeat_seconds=30, requeue_max_age=3600):
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+        self.high_priority_slots = high_priority_slots
+        self.reserved_workers = reserved_workers
+        self.heartbeat_seconds = heartbeat_seconds
+        self.requeue_max_age = requeue_max_age
+        self.app = None
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._workers = []
+        self._busy = 0
+        self._submitted = {p: 0 for p in PRIORITY_NAMES}
+        self._rejected = {p: 0 for p in PRIORITY_NAMES}
+        self._waits = {p: deque(maxlen=500) for p in PRIORITY_NAMES}
+        self._heartbeat = None
+        self._recovered = False
+        self._recover_lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.max_workers = app.config.get('PIPELINE_MAX_WORKERS', self.max_workers)
+        self.queue_size = app.config.get('PIPELINE_QUEUE_SIZE', self.queue_size)
+        self.high_priority_slots = app.config.get('PIPELINE_QUEUE_HIGH_PRIORITY_SLOTS', self.high_priority_slots)
+        self.reserved_workers = app.config.get('PIPELINE_RESERVED_WORKERS', self.reserved_workers)
+        self.heartbeat_seconds = app.config.get('PIPELINE_HEARTBEAT_SECONDS', self.heartbeat_seconds)
+        self.requeue_max_age = app.config.get('PIPELINE_REQUEUE_MAX_AGE_SECONDS', self.requeue_max_age)
+
+    def _start_workers(self):
+        # Called with self._cond held
+        if self._workers:
+            return
+        reserved = min(self.reserved_workers, self.max_workers - 1)
+        for i in range(self.max_workers):
+            high_only = i < reserved
+            worker = threading.Thread(target=self._work, args=(high_only,), daemon=True,
+                                      name=f"pipeline-run-{'high' if high_only else 'any'}-{i}")
+            worker.start()
+            self._workers.append(worker)
+        self._heartbeat = threading.Thread(target=self._heartbeat_loop, name='pipeline-run-heartbeat', daemon=True)
+        self._heartbeat.start()
+
+    def submit(self, run_id, priority=MEDIUM):
+        """
+        Queues a persisted PipelineRun for background execution and returns a
+        Future that resolves once it has run. Raises RunQueueFull when the
+        queue has no room for the given priority.
+        """
+        future = Future()
+        with self._cond:
+            if not self.has_room(priority):
+                self._rejected[priority] += 1
+                raise RunQueueFull(f"Run queue is full ({len(self._heap)} waiting); try again later.")
+            self._start_workers()
+            heapq.heappush(self._heap, (priority, next(self._seq), run_id, time.monotonic(), future))
+            self._submitted[priority] += 1
+            self._cond.notify_all()
+        return future
+
+    def has_room(self, priority=MEDIUM):
+        """Whether a run of the given priority would currently be accepted."""
+        limit = self.queue_size if priority == HIGH else self.queue_size - self.high_priority_slots
+        return len(self._heap) < limit
+
+    def enqueue(self, run):
+        """
+        Queues a run at the priority of its trigger source. If the queue is
+        full the run is marked failed before RunQueueFull is re-raised, so it
+        still shows up in the run history.
+        """
+        from app import db
+        run.runner = self.holder
+        run.heartbeat_at = datetime.utcnow()
+        db.session.commit()
+        try:
+            return self.submit(run.id, TRIGGER_PRIORITIES.get(run.trigger_source, MEDIUM))
+        except RunQueueFull as e:
+            run.status = 'failed'
+            run.error = str(e)
+            run.finished_at = datetime.utcnow()
+            db.session.commit()
+            raise
+
+    def _work(self, high_only):
+        while True:
+            with self._cond:
+                while not self._heap or (high_only and self._heap[0][0] != HIGH):
+                    self._cond.wait()
+                priority, _, run_id, enqueued, future = heapq.heappop(self._heap)
+                self._waits[priority].append(time.monotonic() - enqueued)
+                self._busy += 1
+            try:
+                if future.set_running_or_notify_cancel():
+                    self._execute(run_id)
+                    future.set_result(run_id)
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self._cond:
+                    self._busy -= 1
+
+    def _execute(self, run_id):
+        from app.pipelines.engine import execute_run
+        with self.app.app_context():
+            try:
+                execute_run(run_id)
+            except Exception as e:
+                logger.error(f"Pipeline run {run_id} crashed: {e}")
+
+    def _heartbeat_loop(self):
+        from app import db
+        from app.models import PipelineRun
+        while True:
+            time.sleep(self.heartbeat_seconds)
+            with self._cond:
+                if not self._heap and not self._busy:
+                    continue
+            with self.app.app_context():
+                try:
+                    PipelineRun.query.filter(
+                        PipelineRun.runner == self.holder,
+                        PipelineRun.status.in_(('queued', 'running')),
+                    ).update({'heartbeat_at': datetime.utcnow()}, synchronize_session=False)
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Could not renew pipeline run heartbeats: {e}")
+
+    def recover(self):
+        """
+        Deals with runs left 'queued' or 'running' by a process that exited,
+        found by their stale heartbeat. Running runs and their unfinished steps
+        are failed, so they show as finished and can be resumed; queued runs
+        are queued here again, or failed once older than ``requeue_max_age``.
+        Runs once per process, from its first request, so CLI commands never
+        pick runs up.
+        """
+        if self._recovered:
+            return
+        with self._recover_lock:
+            if self._recovered:
+                return
+            self._recovered = True
+        from app import db
+        from app.models import PipelineRun, StepRun
+
+        now = datetime.utcnow()
+        stale = db.func.coalesce(PipelineRun.heartbeat_at, PipelineRun.created_at) < \
+            now - timedelta(seconds=self.heartbeat_seconds * STALE_HEARTBEATS)
+        try:
+            orphans = PipelineRun.query.filter(PipelineRun.status.in_(('queued', 'running')), stale) \
+                .order_by(PipelineRun.created_at).all()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Could not look for interrupted pipeline runs: {e}")
+            return
+        for run in orphans:
+            try:
+                if run.status == 'queued' and run.created_at >= now - timedelta(seconds=self.requeue_max_age):
+                    claimed = PipelineRun.query.filter(PipelineRun.id == run.id, PipelineRun.status == 'queued', stale) \
+                        .update({'runner': self.holder, 'heartbeat_at': now}, synchronize_session=False)
+                    db.session.commit()
+                    if claimed:
+                        self.enqueue(run)
+                        logger.info(f"Queued pipeline run {run.id} again after a restart.")
+                    continue
+                failed = PipelineRun.query.filter(PipelineRun.id == run.id, PipelineRun.status == run.status, stale) \
+                    .update({'status': 'failed', 'error': INTERRUPTED_ERRORS[run.status], 'finished_at': now}, synchronize_session=False)
+                if failed:
+                    StepRun.query.filter(StepRun.run_id == run.id, StepRun.status.in_(('pending', 'running'))) \
+                        .update({'status': 'failed', 'error': INTERRUPTED_ERRORS[run.status], 'finished_at': now}, synchronize_session=False)
+                    logger.info(f"Failed pipeline run {run.id}, interrupted by a restart.")
+                db.session.commit()
+            except RunQueueFull as e:
+                logger.error(f"Interrupted pipeline run {run.id} rejected: {e}")
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Could not recover pipeline run {run.id}: {e}")
+
+    def stats(self):
+        """Queue depth, busy workers, rejections and recent queue wait times per priority."""
+        from app.pipelines.history import percentile
+        with self._cond:
+            now = time.monotonic()
+            depth = {name: 0 for name in PRIORITY_NAMES.values()}
+            oldest = None
+            for priority, _, _, enqueued, _ in self._heap:
+                depth[PRIORITY_NAMES[priority]] += 1
+                oldest = max(oldest or 0, now - enqueued)
+            waits = {p: sorted(w * 1000 for w in self._waits[p]) for p in PRIORITY_NAMES}
+            return {
+                'queue_size': self.queue_size,
+                'depth': len(self._heap),
+                'depth_by_priority': depth,
+                'oldest_wait_ms': round(oldest * 1000) if oldest is not None else None,
+                'workers': self.max_workers,
+                'busy_workers': self._busy,
+                'priorities': {
+                    name: {
+                        'submitted': self._submitted[p],
+                        'rejected': self._rejected[p],
+                        'wait_p50_ms': round(percentile(waits[p], 50)) if waits[p] else None,
+                        'wait_p95_ms': round(percentile(waits[p], 95)) if waits[p] else None,
+                    }
+                    for p, name in PRIORITY_NAMES.items()
+                },
+            }
+
+
+pipeline_runner = PipelineRunner()
@@ -0,0 +1,132 @@
+"""
+Database-backed leader election for the cron scheduler.
+
+Every process starts the APScheduler instance paused, so web workers can
+still add, edit and remove jobs in the shared job store. Processes that are
+allowed to fire jobs (web processes with the default ``SCHEDULER_MODE=embedded``,
+from ``run.py`` or their first request, and ``flask scheduler run``) compete
+for a single lease row; only the holder resumes the scheduler, and it keeps
+renewing the lease. If the holder dies, the lease expires after
+``SCHEDULER_LEASE_TTL`` seconds and a standby takes over.
+"""
+import atexit
+import logging
+import os
+import socket
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+
+class SchedulerLeader:
+    """Holds (or waits for) the scheduler lease and runs the scheduler only while holding it."""
+
+    def __init__(self, lease_name='scheduler', ttl=30):
+        self.lease_name = lease_name
+        self.ttl = ttl
+        self.app = None
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.is_leader = False
+        self._thread = None
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+        self._last_error = None
+
+    def init_app(self, app):
+        self.app = app
+        self.ttl = app.config.get('SCHEDULER_LEASE_TTL', self.ttl)
+
+    def start(self):
+        """Starts competing for the lease in a background thread (idempotent)."""
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='scheduler-leader', daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Stops competing and hands the lease back so a standby can take over at once."""
+        self._stop.set()
+        if self.is_leader:
+            self._demote()
+            with self.app.app_context():
+                self.release()
+
+    def _run(self):
+        while not self._stop.is_set():
+            with self.app.app_context():
+                holds_lease = self._try_acquire()
+                if holds_lease and not self.is_leader:
+                    self._elect()
+                elif not holds_lease and self.is_leader:
+                    self._demote()
+                elif holds_lease:
+                    # Jobs may have been added to the shared job store by other processes
+                    from app import bg_scheduler
+                    bg_scheduler.wakeup()
+            self._stop.wait(max(self.ttl / 3, 1))
+
+    def _try_acquire(self):
+        """Takes or renews the lease. Returns True while this process holds it."""
+        from app import db
+        from app.models import SchedulerLease
+
+        now = datetime.utcnow()
+        expires_at = now + timedelta(seconds=self.ttl)
+        try:
+            renewed = SchedulerLease.query.filter(
+                SchedulerLease.name == self.lease_name,
+                or_(SchedulerLease.holder == self.holder, SchedulerLease.expires_at < now),
+            ).update({'holder': self.holder, 'expires_at': expires_at, 'renewed_at': now}, synchronize_session=False)
+            db.session.commit()
+            if renewed:
+                self._last_error = None
+                return True
+            if SchedulerLease.query.get(self.lease_name) is not None:
+                return False
+            db.session.add(SchedulerLease(name=self.lease_name, holder=self.holder, expires_at=expires_at, renewed_at=now))
+            db.session.commit()
+            return True
+        except IntegrityError:
+            # Another process created the lease row first
+            db.session.rollback()
+            return False
+        except Exception as e:
+            db.session.rollback()
+            if str(e) != self._last_error:
+                logger.error(f"Could not acquire scheduler lease: {e}")
+                self._last_error = str(e)
+            return False
+
+    def release(self):
+        from app import db
+        from app.models import SchedulerLease
+        try:
+            SchedulerLease.query.filter_by(name=self.lease_name, holder=self.holder).update(
+                {'expires_at': datetime.utcnow()}, synchronize_session=False)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Could not release scheduler lease: {e}")
+
+    def _elect(self):
+        from app import bg_scheduler, resync_scheduler_jobs
+        print(f"INFO: {self.holder} acquired the scheduler lease; firing scheduled jobs.")
+        self.is_leader = True
+        resync_scheduler_jobs(self.app)
+        bg_scheduler.resume()
+
+    def _demote(self):
+        from app import bg_scheduler
+        print(f"INFO: {self.holder} lost the scheduler lease; pausing scheduled jobs.")
+        self.is_leader = False
+        bg_scheduler.pause()
+
+
+scheduler_leader = SchedulerLeader()
@@ -5,25 +5,33 @@ from app import db
 from app import bg_scheduler as scheduler # Use the renamed scheduler object
 from app.models import ScheduledJob, Pipeline
 from croniter import croniter
-from datetime import datetime
-from apscheduler.triggers.cron import CronTrigger
-from app.scheduler.tasks import pipeline_task # Import the task function
+from sqlalchemy.orm import joinedload
+from app.pipelines.runner import RunQueueFull
+from app.scheduler.tasks import schedule_job, scheduler_worker
 
 @bp.route('/')
 @login_required
 def schedule_list():
-    """Displays the list of all scheduled jobs."""
-    jobs = ScheduledJob.query.order_by(ScheduledJob.name).all()
-    # Update next_run time for display
-    for job in jobs:
-        if job.is_enabled and croniter.is_valid(job.cron_string):
-            try:
-                job.next_run = croniter(job.cron_string, datetime.now()).get_next(datetime)
-            except:
-                job.next_run = None # Handle potential croniter errors
+    """Displays one page of scheduled jobs. next_run is kept up to date by the scheduler's event listener."""
+    page = request.args.get('page', 1, type=int)
+    per_page = min(request.args.get('per_page', 50, type=int), 200)
+    pagination = ScheduledJob.query.options(joinedload(ScheduledJob.pipeline)) \
+        .order_by(ScheduledJob.name, ScheduledJob.id) \
+        .paginate(page=page, per_page=per_page, error_out=False)
     
     pipelines = Pipeline.query.order_by(Pipeline.name).all()
-    return render_template('scheduler/scheduler.html', title="Pipeline Scheduler", jobs=jobs, pipelines=pipelines)
+    return render_template('scheduler/scheduler.html', title="Pipeline Scheduler", jobs=pagination.items, pagination=pagination, pipelines=pipelines)
+
+def _storm_control_fields(form):
+    """Reads the optional jitter/coalesce/max-instances fields; blank means 'use the default'."""
+    jitter = form.get('jitter_seconds', '').strip()
+    max_instances = form.get('max_instances', '').strip()
+    coalesce = form.get('coalesce', '')
+    return {
+        'jitter_seconds': max(0, int(jitter)) if jitter else None,
+        'max_instances': max(1, int(max_instances)) if max_instances else None,
+        'coalesce': {'yes': True, 'no': False}.get(coalesce),
+    }
 
 @bp.route('/add', methods=['POST'])
 @login_required
@@ -42,18 +50,12 @@ def add_schedule():
         return redirect(url_for('scheduler.schedule_list'))
 
     try:
-        new_job = ScheduledJob(name=name, pipeline_id=pipeline_id, cron_string=cron_string, is_enabled=True)
+        new_job = ScheduledJob(name=name, pipeline_id=pipeline_id, cron_string=cron_string, is_enabled=True,
+                               **_storm_control_fields(request.form))
         db.session.add(new_job)
         db.session.commit()
         
-        trigger = CronTrigger.from_crontab(cron_string)
-        scheduler.add_job(
-            id=str(new_job.id),
-            func='app.scheduler.tasks:pipeline_task',
-            args=[new_job.id],
-            trigger=trigger,
-            replace_existing=True
-        )
+        schedule_job(new_job)
         flash(f'Scheduled job "{name}" added successfully.', 'success')
     except Exception as e:
         db.session.rollback()
@@ -82,9 +84,10 @@ def edit_schedule(job_id):
         job.name = name
         job.pipeline_id = pipeline_id
         job.cron_string = cron_string
+        for field, value in _storm_control_fields(request.form).items():
+            setattr(job, field, value)
         
-        trigger = CronTrigger.from_crontab(cron_string)
-        scheduler.modify_job(id=str(job.id), trigger=trigger)
+        schedule_job(job)
         
         db.session.commit()
         flash(f'Scheduled job "{job.name}" updated successfully.', 'success')
@@ -100,16 +103,16 @@ def edit_schedule(job_id):
 def run_now(job_id):
     """Triggers a scheduled job to run immediately."""
     job = ScheduledJob.query.get_or_404(job_id)
+    if not job.is_enabled:
+        flash(f'Job "{job.name}" is disabled; enable it to run it.', 'error')
+        return redirect(url_for('scheduler.schedule_list'))
     try:
-        scheduler.add_job(
-            id=f"manual_run_{job.id}_{datetime.now().timestamp()}",
-            func='app.scheduler.tasks:pipeline_task',
-            args=[job.id],
-            trigger='date',
-            replace_existing=False
-        )
-        flash(f'Job "{job.name}" has been triggered to run now.', 'success')
+        run = scheduler_worker.run_now(job)
+        flash(f'Job "{job.name}" has been queued to run now (run #{run.id}).', 'success')
+    except RunQueueFull as e:
+        flash(f'Error triggering job: {e}', 'error')
     except Exception as e:
+        db.session.rollback()
         flash(f'Error triggering job: {e}', 'error')
         
     return redirect(url_for('scheduler.schedule_list'))
@@ -122,10 +125,7 @@ def toggle_schedule(job_id):
     job.is_enabled = not job.is_enabled
     
     try:
-        if job.is_enabled:
-            scheduler.resume_job(str(job.id))
-        else:
-            scheduler.pause_job(str(job.id))
+        schedule_job(job)
         db.session.commit()
         flash(f'Job "{job.name}" has been {"enabled" if job.is_enabled else "disabled"}.', 'success')
     except Exception as e:
@@ -1,24 +1,168 @@
-from app import create_app, db
+from apscheduler.events import (
+    EVENT_JOB_ADDED, EVENT_JOB_MODIFIED, EVENT_JOB_REMOVED, EVENT_JOB_SUBMITTED, EVENT_JOB_MAX_INSTANCES,
+)
+from apscheduler.triggers.cron import CronTrigger
+from flask import current_app
+from app import db, bg_scheduler
 from app.models import ScheduledJob
-from datetime import datetime
+from datetime import datetime, timezone
+import threading
+import time
 
-def pipeline_task(job_id):
+
+class SchedulerWorker:
     """
-    The actual task that the scheduler will run in the background.
-    It creates its own app context to access the database.
+    Runs scheduled pipeline jobs inside the long-lived app that started the
+    scheduler, so a cron firing costs an app context push instead of a full
+    create_app().
     """
-    app = create_app()
-    with app.app_context():
-        job = ScheduledJob.query.get(job_id)
-        if job and job.is_enabled:
+
+    def __init__(self):
+        self.app = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+
+    def get_app(self):
+        # Only reached if a job fires in a process whose app never registered
+        # itself; build one app for the process and keep it.
+        with self._lock:
+            if self.app is None:
+                from app import create_app
+                self.app = create_app()
+            return self.app
+
+    def run_job(self, job_id, trigger_source='cron'):
+        with self.get_app().app_context():
+            from app.pipelines.engine import create_run
+            from app.pipelines.runner import pipeline_runner, RunQueueFull
+
+            job = ScheduledJob.query.get(job_id)
+            if not job or not job.is_enabled:
+                return
+
             print(f"--- Running scheduled pipeline: {job.pipeline.name} ---")
-            
-            # TODO: Add the full pipeline execution logic here.
-            # This would involve calling a function similar to run_pipeline()
-            # from your pipelines/routes.py file. For now, it's a placeholder.
-            
-            job.last_run = datetime.utcnow()
-            db.session.add(job)
-            db.session.commit()
-            
-            print(f"--- Finished scheduled pipeline: {job.pipeline.name} ---")
+            started_at = datetime.utcnow()
+            started = time.perf_counter()
+            # Run through the same engine and queue as the UI and Zabbix trigger;
+            # cron runs are queued at low priority so alerts overtake them
+            try:
+                run = create_run(job.pipeline, {}, trigger_source=trigger_source, scheduled_job_id=job.id)
+                pipeline_runner.enqueue(run).result()
+                db.session.refresh(run)
+                status = run.status
+                print(f"--- Finished scheduled pipeline: {job.pipeline.name} ({status}) ---")
+            except RunQueueFull as e:
+                status = 'rejected'
+                print(f"--- Scheduled pipeline {job.pipeline.name} not run: {e} ---")
+            except Exception as e:
+                db.session.rollback()
+                status = 'failed'
+                print(f"--- Scheduled pipeline {job.pipeline.name} failed: {e} ---")
+
+            self._record(job, started_at, started, status)
+
+    def run_now(self, job):
+        """
+        Queues a run of a scheduled job straight away on this process's run
+        queue, instead of handing it to the scheduler, which only fires jobs
+        in the process holding the lease. The job's last run is recorded once
+        the run finishes. Returns the PipelineRun; raises RunQueueFull or
+        PipelineCycleError.
+        """
+        from app.models import PipelineRun
+        from app.pipelines.engine import create_run
+        from app.pipelines.runner import pipeline_runner, RunQueueFull
+
+        started_at = datetime.utcnow()
+        started = time.perf_counter()
+        run = create_run(job.pipeline, {}, trigger_source='run_now', scheduled_job_id=job.id)
+        job_id, run_id = job.id, run.id
+
+        def finished(future):
+            with self.get_app().app_context():
+                finished_job = ScheduledJob.query.get(job_id)
+                if finished_job:
+                    self._record(finished_job, started_at, started, db.session.get(PipelineRun, run_id).status)
+
+        try:
+            pipeline_runner.enqueue(run).add_done_callback(finished)
+        except RunQueueFull:
+            self._record(job, started_at, started, 'rejected')
+            raise
+        return run
+
+    @staticmethod
+    def _record(job, started_at, started, status):
+        job.last_run = started_at
+        job.last_duration_ms = round((time.perf_counter() - started) * 1000)
+        job.last_status = status
+        db.session.commit()
+
+def cron_trigger(cron_string, jitter=None):
+    """Same as CronTrigger.from_crontab, plus a random start delay of up to ``jitter`` seconds."""
+    minute, hour, day, month, day_of_week = cron_string.split()
+    return CronTrigger(minute=minute, hour=hour, day=day, month=month, day_of_week=day_of_week, jitter=jitter or None)
+
+
+def schedule_job(job):
+    """
+    Adds or replaces a ScheduledJob in the scheduler with its storm-control
+    policy, falling back to the SCHEDULER_* config defaults. Disabled jobs are
+    stored paused.
+    """
+    config = current_app.config
+    jitter = job.jitter_seconds if job.jitter_seconds is not None else config.get('SCHEDULER_JITTER_SECONDS', 0)
+    coalesce = job.coalesce if job.coalesce is not None else config.get('SCHEDULER_COALESCE', True)
+    bg_scheduler.add_job(
+        id=str(job.id),
+        func='app.scheduler.tasks:pipeline_task', # Pass as string to avoid pickling issues
+        args=[job.id],
+        trigger=cron_trigger(job.cron_string, jitter),
+        coalesce=coalesce,
+        max_instances=job.max_instances or config.get('SCHEDULER_MAX_INSTANCES', 1),
+        replace_existing=True,
+        misfire_grace_time=3600 # Grace time of 1 hour for missed jobs
+    )
+    if not job.is_enabled:
+        bg_scheduler.pause_job(str(job.id))
+
+
+def next_fire_time(job_id):
+    """The scheduler's next fire time for a job as naive UTC, or None if it is not scheduled."""
+    scheduled = bg_scheduler.get_job(str(job_id))
+    if scheduled is None or scheduled.next_run_time is None:
+        return None
+    return scheduled.next_run_time.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+# Every event after which a job's next fire time may have changed
+NEXT_RUN_EVENTS = EVENT_JOB_ADDED | EVENT_JOB_MODIFIED | EVENT_JOB_REMOVED | EVENT_JOB_SUBMITTED | EVENT_JOB_MAX_INSTANCES
+
+
+def sync_next_run(event):
+    """
+    Scheduler listener that copies a job's next fire time into
+    ScheduledJob.next_run, so pages can read it straight from the database.
+    Writes on its own connection because it may run in the middle of a
+    request that has not committed yet.
+    """
+    if not str(event.job_id).isdigit():
+        return  # one-off jobs have no ScheduledJob row of their own
+    next_run = None if event.code == EVENT_JOB_REMOVED else next_fire_time(event.job_id)
+    table = ScheduledJob.__table__
+    with scheduler_worker.get_app().app_context():
+        with db.engine.begin() as conn:
+            conn.execute(table.update().where(table.c.id == int(event.job_id)).values(next_run=next_run))
+
+
+scheduler_worker = SchedulerWorker()
+
+
+def pipeline_task(job_id, trigger_source='cron'):
+    """
+    The actual task that the scheduler will run in the background.
+    Reuses the long-lived app registered with the scheduler worker.
+    """
+    scheduler_worker.run_job(job_id, trigger_source)
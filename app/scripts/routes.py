@@ -5,8 +5,7 @@ from .. import db
 # from config import Config # MODIFIED: Removed unused import
 from github import Github, UnknownObjectException
 import base64
-import google.generativeai as genai
-import openai
+from app.ai import ai_clients
 from app.utils import get_repo_scripts_recursive, get_script_icon
 from flask_login import login_required, current_user
 import functools
@@ -204,19 +203,7 @@ def analyze_script():
     
     analysis_prompt = f"You are a helpful DevOps assistant. Analyze the following script. Use 'HEADING: ' to mark section titles for 'Summary', 'Dependencies', 'Expected Outcome', and 'Potential Issues'.\n\nScript:\n```\n{script}\n```"
     try:
-        if ai_provider == 'gemini':
-            api_key = app_config.get('gemini_api_key')
-            if not api_key: return jsonify({'error': 'Gemini API key is not configured.'}), 500
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel('gemini-1.5-flash')
-            response = model.generate_content(analysis_prompt)
-            analysis = response.text
-        else: # ChatGPT
-            api_key = app_config.get('chatgpt_api_key')
-            if not api_key: return jsonify({'error': 'ChatGPT API key is not configured.'}), 500
-            client = openai.OpenAI(api_key=api_key)
-            response = client.chat.completions.create(model="gpt-3.5-turbo", messages=[{"role": "user", "content": analysis_prompt}])
-            analysis = response.choices[0].message.content
-        return jsonify({'output': analysis})
+        analysis, cached = ai_clients.cached_complete(analysis_prompt, ai_provider, app_config, refresh=data.get('no_cache', False))
+        return jsonify({'output': analysis, 'cached': cached})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
\ No newline at end of file
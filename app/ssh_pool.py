@@ -0,0 +1,303 @@
+"""
+Shared pool of reusable SSH connections.
+
+Every remote execution path (ad-hoc script runs, pipelines, Zabbix triggers)
+borrows a connection from the module-level ``ssh_pool`` instead of building a
+fresh ``paramiko.SSHClient`` per command. Connections are keyed by
+(host, port, user, auth method), kept alive with transport keepalives, health
+checked before reuse and closed once they have been idle for too long.
+"""
+import codecs
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+import paramiko
+
+from app.output_capture import output_store
+
+logger = logging.getLogger(__name__)
+
+# Everything needed to open a connection, captured up-front so worker threads
+# never have to touch a SQLAlchemy object.
+SSHTarget = namedtuple('SSHTarget', ['hostname', 'port', 'username', 'key_filename', 'password'])
+
+
+class SSHPoolExhausted(Exception):
+    """Raised when no connection slot frees up for a host within the acquire timeout."""
+
+
+def target_for_host(host, port=22):
+    """Builds an SSHTarget from a Host model (or any object with the same attributes)."""
+    key = getattr(host, 'ssh_key', None)
+    password = getattr(host, 'password', None)
+    return SSHTarget(
+        hostname=host.ip_address if host.ip_address else host.name,
+        port=port,
+        username=host.ssh_user,
+        key_filename=os.path.expanduser(key) if key else None,
+        password=password or None,
+    )
+
+
+class _PooledConnection:
+    __slots__ = ('key', 'client', 'created_at', 'last_used')
+
+    def __init__(self, key, client):
+        self.key = key
+        self.client = client
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+
+class SSHConnectionPool:
+    """A thread-safe pool of authenticated SSH connections."""
+
+    def __init__(self, max_per_host=4, idle_timeout=300, keepalive_interval=30,
+                 connect_timeout=10, acquire_timeout=60, max_lifetime=3600):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.keepalive_interval = keepalive_interval
+        self.connect_timeout = connect_timeout
+        self.acquire_timeout = acquire_timeout
+        self.max_lifetime = max_lifetime
+
+        self._cond = threading.Condition()
+        self._idle = {}     # pool key -> list of idle _PooledConnection
+        self._in_use = {}   # pool key -> number of checked-out (or connecting) slots
+        self._reaper = None
+
+    def init_app(self, app):
+        """Reads pool settings from the app config and starts the idle reaper."""
+        self.max_per_host = app.config.get('SSH_POOL_MAX_PER_HOST', self.max_per_host)
+        self.idle_timeout = app.config.get('SSH_POOL_IDLE_TIMEOUT', self.idle_timeout)
+        self.keepalive_interval = app.config.get('SSH_KEEPALIVE_INTERVAL', self.keepalive_interval)
+        self.connect_timeout = app.config.get('SSH_CONNECT_TIMEOUT', self.connect_timeout)
+        self.acquire_timeout = app.config.get('SSH_POOL_ACQUIRE_TIMEOUT', self.acquire_timeout)
+        self.max_lifetime = app.config.get('SSH_POOL_MAX_LIFETIME', self.max_lifetime)
+
+        if self._reaper is None:
+            self._reaper = threading.Thread(target=self._reap_loop, name='ssh-pool-reaper', daemon=True)
+            self._reaper.start()
+
+    # --- Keys and connection setup ---
+    @staticmethod
+    def pool_key(target):
+        """Connections are only shared between identical host/user/auth combinations."""
+        if target.key_filename:
+            auth = ('key', target.key_filename)
+        elif target.password:
+            auth = ('password', target.password)
+        else:
+            auth = ('agent',)
+        return (target.hostname, target.port, target.username, auth)
+
+    def _connect(self, target):
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        kwargs = {
+            'hostname': target.hostname,
+            'port': target.port,
+            'username': target.username,
+            'timeout': self.connect_timeout,
+        }
+        if target.key_filename:
+            kwargs['key_filename'] = target.key_filename
+        elif target.password:
+            kwargs['password'] = target.password
+        else:
+            kwargs['look_for_keys'] = True
+
+        logger.info(f"Opening pooled SSH connection to {target.hostname} for user {target.username}")
+        client.connect(**kwargs)
+        transport = client.get_transport()
+        if transport is not None and self.keepalive_interval:
+            transport.set_keepalive(self.keepalive_interval)
+        return client
+
+    def _is_healthy(self, conn):
+        if time.monotonic() - conn.created_at > self.max_lifetime:
+            return False
+        transport = conn.client.get_transport()
+        return transport is not None and transport.is_active() and transport.is_authenticated()
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.client.close()
+        except Exception:
+            pass
+
+    # --- Checkout / checkin ---
+    def acquire(self, target, timeout=None):
+        """
+        Checks out a healthy connection for the target, opening one if the
+        host is below its connection limit and waiting otherwise.
+        """
+        key = self.pool_key(target)
+        timeout = self.acquire_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        stale = []
+
+        with self._cond:
+            while True:
+                idle = self._idle.get(key, [])
+                conn = None
+                while idle:
+                    candidate = idle.pop()
+                    if self._is_healthy(candidate):
+                        conn = candidate
+                        break
+                    stale.append(candidate)
+                if conn is not None or self._in_use.get(key, 0) < self.max_per_host:
+                    self._in_use[key] = self._in_use.get(key, 0) + 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise SSHPoolExhausted(f"No SSH connection to {target.hostname} became available within {timeout}s.")
+                self._cond.wait(remaining)
+
+        for old in stale:
+            self._close(old)
+
+        if conn is not None:
+            return conn
+
+        # Connect outside the lock so a slow handshake does not block other hosts.
+        try:
+            return _PooledConnection(key, self._connect(target))
+        except Exception:
+            with self._cond:
+                self._in_use[key] -= 1
+                self._cond.notify_all()
+            raise
+
+    def release(self, conn, discard=False):
+        """Returns a connection to the pool, or closes it if it is broken."""
+        keep = not discard and self._is_healthy(conn)
+        with self._cond:
+            self._in_use[conn.key] -= 1
+            if keep:
+                conn.last_used = time.monotonic()
+                self._idle.setdefault(conn.key, []).append(conn)
+            self._cond.notify_all()
+        if not keep:
+            self._close(conn)
+
+    def exec_command(self, target, command):
+        """
+        Runs a command over a pooled connection and returns (stdout, stderr, exit_code).
+        stdout and stderr are bounded OutputCapture objects; str() gives the
+        (possibly truncated) text and the full stream is spilled to disk if large.
+        """
+        stdout, stderr = output_store.capture(), output_store.capture()
+        exit_code = None
+        try:
+            for kind, payload in self.stream_command(target, command):
+                if kind == 'exit':
+                    exit_code = payload
+                elif kind == 'stdout':
+                    stdout.write(payload)
+                else:
+                    stderr.write(payload)
+        finally:
+            stdout.close()
+            stderr.close()
+        return stdout, stderr, exit_code
+
+    def _open_channel(self, target, command):
+        """
+        Checks out a connection and starts the command on a new channel.
+        A connection that died while idle is retried once on a fresh one.
+        """
+        for attempt in (1, 2):
+            conn = self.acquire(target)
+            try:
+                channel = conn.client.get_transport().open_session()
+                channel.exec_command(command)
+                return conn, channel
+            except (paramiko.SSHException, OSError, EOFError, AttributeError):
+                self.release(conn, discard=True)
+                if attempt == 2:
+                    raise
+
+    def stream_command(self, target, command, chunk_size=4096, poll_interval=0.05):
+        """
+        Runs a command over a pooled connection and yields ('stdout', text) and
+        ('stderr', text) chunks as they arrive, followed by a final ('exit', code).
+        Nothing is buffered beyond a single chunk.
+        """
+        conn, channel = self._open_channel(target, command)
+        broken = False
+        try:
+            decoders = {
+                'stdout': codecs.getincrementaldecoder('utf-8')(errors='replace'),
+                'stderr': codecs.getincrementaldecoder('utf-8')(errors='replace'),
+            }
+            while True:
+                received = False
+                if channel.recv_ready():
+                    text = decoders['stdout'].decode(channel.recv(chunk_size))
+                    received = True
+                    if text:
+                        yield 'stdout', text
+                if channel.recv_stderr_ready():
+                    text = decoders['stderr'].decode(channel.recv_stderr(chunk_size))
+                    received = True
+                    if text:
+                        yield 'stderr', text
+                if not received:
+                    if channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+                        break
+                    time.sleep(poll_interval)
+            for stream, decoder in decoders.items():
+                tail = decoder.decode(b'', final=True)
+                if tail:
+                    yield stream, tail
+            yield 'exit', channel.recv_exit_status()
+        except (paramiko.SSHException, OSError, EOFError):
+            broken = True
+            raise
+        finally:
+            # Also reached when the consumer stops early (e.g. the browser disconnected).
+            try:
+                channel.close()
+            except Exception:
+                broken = True
+            self.release(conn, discard=broken)
+
+    # --- Maintenance ---
+    def evict_idle(self):
+        """Closes connections that have been idle too long or are no longer healthy."""
+        now = time.monotonic()
+        evicted = []
+        with self._cond:
+            for key, idle in list(self._idle.items()):
+                keep = []
+                for conn in idle:
+                    if now - conn.last_used > self.idle_timeout or not self._is_healthy(conn):
+                        evicted.append(conn)
+                    else:
+                        keep.append(conn)
+                if keep:
+                    self._idle[key] = keep
+                else:
+                    del self._idle[key]
+        for conn in evicted:
+            self._close(conn)
+        return len(evicted)
+
+    def _reap_loop(self):
+        while True:
+            time.sleep(max(1, min(self.idle_timeout, 60)))
+            try:
+                evicted = self.evict_idle()
+                if evicted:
+                    logger.info(f"Evicted {evicted} idle SSH connection(s).")
+            except Exception as e:
+                logger.error(f"SSH pool reaper failed: {e}")
+
+
+ssh_pool = SSHConnectionPool()
@@ -1,13 +1,10 @@
 # Combined imports for all utility functions
-import os
 import subprocess
 import socket
-import base64
-import paramiko
+import json
 import requests # Import requests for Discord notifications
-from openai import OpenAI
 from github import Github, UnknownObjectException
-from flask import current_app
+from flask import current_app, Response, stream_with_context
 import time # Import time for rate limiting
 
 # --- GitHub Functions ---
@@ -76,77 +73,7 @@ def get_distros():
         'Rocky Linux', 'AlmaLinux', 'Amazon Linux', 'Other'
     ]
 
-# --- SSH, AI, and Notification Functions ---
-def execute_ssh_command(host, command):
-    """
-    Executes a command on a remote host via SSH using Paramiko and returns the output.
-    """
-    try:
-        client = paramiko.SSHClient()
-        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-        connect_to = host.ip_address if host.ip_address else host.name
-        current_app.logger.info(f"Attempting SSH connection to {connect_to} for user {host.ssh_user}")
-
-        if hasattr(host, 'ssh_key') and host.ssh_key:
-            current_app.logger.info("Connecting using explicit SSH key from database.")
-            key_path = os.path.expanduser(host.ssh_key)
-            client.connect(connect_to, username=host.ssh_user, key_filename=key_path, port=22, timeout=10)
-        elif hasattr(host, 'password') and host.password:
-            current_app.logger.info("Connecting using explicit password from database.")
-            client.connect(connect_to, username=host.ssh_user, password=host.password, port=22, timeout=10)
-        else:
-            current_app.logger.info("No explicit credentials in DB. Attempting connection with default agent keys.")
-            client.connect(connect_to, username=host.ssh_user, port=22, timeout=10)
-
-        stdin, stdout, stderr = client.exec_command(command)
-        output = stdout.read().decode('utf-8')
-        error = stderr.read().decode('utf-8')
-        
-        client.close()
-        current_app.logger.info("SSH command executed successfully.")
-        return output, error
-    except Exception as e:
-        current_app.logger.error(f"Exception during SSH command execution: {e}")
-        return None, str(e)
-
-def get_ai_analysis(diagnostic_data, context, api_key):
-    """
-    Sends diagnostic data to OpenAI for analysis and returns the response.
-    """
-    try:
-        if not api_key:
-            current_app.logger.error("AI analysis call failed: No API key was provided.")
-            return "Error: AI analysis is not configured because the OpenAI API key is missing."
-
-        client = OpenAI(api_key=api_key)
-        prompt = f"""
-        You are an expert systems administrator and IT operations analyst.
-        {context}
-
-        Here is the diagnostic data collected from the server:
-        ---
-        {diagnostic_data}
-        ---
-
-        Based on the data, please provide:
-        1. A brief, clear synopsis of the likely problem.
-        2. A list of recommended, actionable troubleshooting steps to resolve the issue.
-        3. Any other important observations or potential underlying causes.
-        """
-
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are an expert systems administrator and IT operations analyst."},
-                {"role": "user", "content": prompt}
-            ]
-        )
-        return response.choices[0].message.content.strip()
-    except Exception as e:
-        current_app.logger.error(f"Error during AI analysis: {e}")
-        return f"An error occurred while trying to get AI analysis: {e}"
-
+# --- Notification Functions ---
 def send_to_discord(webhook_url, message_content):
     """
     Sends a message to a Discord webhook, splitting it into multiple messages if it's too long.
@@ -207,6 +134,27 @@ def send_to_discord(webhook_url, message_content):
         return True, "Multi-part message sent to Discord."
 
 
+# --- Streaming Helpers ---
+def sse_response(events):
+    """
+    Wraps an iterable of event dicts (each with an 'event' key) in a
+    Server-Sent Events response. Closing the connection closes the iterable.
+    """
+    def generate():
+        try:
+            for event in events:
+                yield f"event: {event.get('event', 'message')}\ndata: {json.dumps(event)}\n\n"
+        finally:
+            if hasattr(events, 'close'):
+                events.close()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
 # --- Validation and Testing Functions ---
 def test_ssh_connection(ip_address, ssh_user):
     """Test SSH connection to a host using the system's SSH command."""
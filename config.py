@@ -14,6 +14,88 @@ class Config:
     GOOGLE_CLIENT_ID = None
     GOOGLE_CLIENT_SECRET = None
 
+    # SSH connection pool settings
+    SSH_CONNECT_TIMEOUT = int(os.environ.get('SSH_CONNECT_TIMEOUT', 10))
+    SSH_KEEPALIVE_INTERVAL = int(os.environ.get('SSH_KEEPALIVE_INTERVAL', 30))
+    SSH_POOL_MAX_PER_HOST = int(os.environ.get('SSH_POOL_MAX_PER_HOST', 4))
+    SSH_POOL_IDLE_TIMEOUT = int(os.environ.get('SSH_POOL_IDLE_TIMEOUT', 300))
+    SSH_POOL_ACQUIRE_TIMEOUT = int(os.environ.get('SSH_POOL_ACQUIRE_TIMEOUT', 60))
+    SSH_POOL_MAX_LIFETIME = int(os.environ.get('SSH_POOL_MAX_LIFETIME', 3600))
+
+    # Multi-host fan-out limits (total across the process, and per request)
+    EXECUTOR_MAX_WORKERS = int(os.environ.get('EXECUTOR_MAX_WORKERS', 32))
+    EXECUTOR_MAX_WORKERS_PER_REQUEST = int(os.environ.get('EXECUTOR_MAX_WORKERS_PER_REQUEST', 16))
+    # Separate cap on hosts streaming output to browsers, so slow readers can't starve pipeline steps
+    EXECUTOR_STREAM_MAX_WORKERS = int(os.environ.get('EXECUTOR_STREAM_MAX_WORKERS', 8))
+
+    # Command output capture: head/tail kept in memory, full stream spilled to disk when larger
+    OUTPUT_HEAD_CHARS = int(os.environ.get('OUTPUT_HEAD_CHARS', 32768))
+    OUTPUT_TAIL_CHARS = int(os.environ.get('OUTPUT_TAIL_CHARS', 32768))
+    OUTPUT_SPILL_DIR = os.environ.get('OUTPUT_SPILL_DIR') or os.path.join(basedir, 'outputs')
+    OUTPUT_RETENTION_HOURS = int(os.environ.get('OUTPUT_RETENTION_HOURS', 72))
+
+    # Background pipeline execution
+    PIPELINE_MAX_WORKERS = int(os.environ.get('PIPELINE_MAX_WORKERS', 4))
+    # Runs waiting for a worker; the last slots and reserved workers only take alert-triggered runs
+    PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', 100))
+    PIPELINE_QUEUE_HIGH_PRIORITY_SLOTS = int(os.environ.get('PIPELINE_QUEUE_HIGH_PRIORITY_SLOTS', 20))
+    PIPELINE_RESERVED_WORKERS = int(os.environ.get('PIPELINE_RESERVED_WORKERS', 1))
+    # Each process marks its queued and running runs alive this often; runs it stops marking (after a
+    # restart or crash) are failed when running, or queued again unless older than the max age
+    PIPELINE_HEARTBEAT_SECONDS = int(os.environ.get('PIPELINE_HEARTBEAT_SECONDS', 30))
+    PIPELINE_REQUEUE_MAX_AGE_SECONDS = int(os.environ.get('PIPELINE_REQUEUE_MAX_AGE_SECONDS', 3600))
+    PIPELINE_MAX_PARALLEL_STEPS = int(os.environ.get('PIPELINE_MAX_PARALLEL_STEPS', 8))
+    PIPELINE_MAX_STEPS_PER_HOST = int(os.environ.get('PIPELINE_MAX_STEPS_PER_HOST', 2))
+    PIPELINE_MATRIX_MAX_HOSTS = int(os.environ.get('PIPELINE_MATRIX_MAX_HOSTS', 8))
+    PIPELINE_PLAN_CACHE_SIZE = int(os.environ.get('PIPELINE_PLAN_CACHE_SIZE', 256))
+    RUN_HISTORY_RETENTION_DAYS = int(os.environ.get('RUN_HISTORY_RETENTION_DAYS', 30))
+
+    # Alert storm control: repeats of a (host, pipeline, trigger) alert join its in-flight run for up to this long,
+    # and after the first alert is queued, the same trigger on other hosts within this window shares one run (0 disables)
+    ALERT_DEDUP_SECONDS = int(os.environ.get('ALERT_DEDUP_SECONDS', 300))
+    ALERT_COALESCE_SECONDS = int(os.environ.get('ALERT_COALESCE_SECONDS', 5))
+    ALERT_BATCH_MAX_SIZE = int(os.environ.get('ALERT_BATCH_MAX_SIZE', 500))
+
+    # Minimum seconds between host-index reloads triggered by unknown host names
+    HOST_CACHE_REFRESH_SECONDS = int(os.environ.get('HOST_CACHE_REFRESH_SECONDS', 30))
+
+    # Cron scheduler: by default ('embedded') web processes compete for the scheduler lease, so one
+    # of them fires jobs; 'off' leaves that to a dedicated `flask scheduler run` process
+    SCHEDULER_MODE = os.environ.get('SCHEDULER_MODE', 'embedded')
+    SCHEDULER_LEASE_TTL = int(os.environ.get('SCHEDULER_LEASE_TTL', 30))
+    # Storm control defaults for jobs that don't set their own: random start delay of up
+    # to N seconds, collapse missed runs into one, and limit concurrent runs per job and overall
+    SCHEDULER_JITTER_SECONDS = int(os.environ.get('SCHEDULER_JITTER_SECONDS', 30))
+    SCHEDULER_COALESCE = os.environ.get('SCHEDULER_COALESCE', 'true').lower() == 'true'
+    SCHEDULER_MAX_INSTANCES = int(os.environ.get('SCHEDULER_MAX_INSTANCES', 1))
+    SCHEDULER_MAX_CONCURRENT_JOBS = int(os.environ.get('SCHEDULER_MAX_CONCURRENT_JOBS', 4))
+
+    # AI providers: models, per-call timeouts (per provider, defaulting to AI_TIMEOUT_SECONDS) and retries.
+    # 'local' uses the OpenAI-compatible server at AI_LOCAL_BASE_URL, or an offline stand-in if unset;
+    # AI_PROVIDER_OVERRIDE forces one provider everywhere
+    AI_GEMINI_MODEL = os.environ.get('AI_GEMINI_MODEL', 'gemini-1.5-flash')
+    AI_OPENAI_MODEL = os.environ.get('AI_OPENAI_MODEL', 'gpt-3.5-turbo')
+    AI_LOCAL_MODEL = os.environ.get('AI_LOCAL_MODEL', 'llama3')
+    AI_LOCAL_BASE_URL = os.environ.get('AI_LOCAL_BASE_URL')
+    AI_PROVIDER_OVERRIDE = os.environ.get('AI_PROVIDER_OVERRIDE')
+    AI_TIMEOUT_SECONDS = int(os.environ.get('AI_TIMEOUT_SECONDS', 60))
+    AI_GEMINI_TIMEOUT_SECONDS = int(os.environ.get('AI_GEMINI_TIMEOUT_SECONDS', AI_TIMEOUT_SECONDS))
+    AI_OPENAI_TIMEOUT_SECONDS = int(os.environ.get('AI_OPENAI_TIMEOUT_SECONDS', AI_TIMEOUT_SECONDS))
+    AI_LOCAL_TIMEOUT_SECONDS = int(os.environ.get('AI_LOCAL_TIMEOUT_SECONDS', AI_TIMEOUT_SECONDS))
+    AI_MAX_RETRIES = int(os.environ.get('AI_MAX_RETRIES', 2))
+    # Diagnostic data over this many (estimated) tokens is summarized in chunks, this many at a time
+    AI_CHUNK_TOKENS = int(os.environ.get('AI_CHUNK_TOKENS', 6000))
+    AI_CHUNK_CONCURRENCY = int(os.environ.get('AI_CHUNK_CONCURRENCY', 4))
+    # Compaction of diagnostic data before analysis: escape codes and repeated lines are always removed,
+    # sections keep their first and last lines up to this many, and a token budget (0 for none) caps the rest
+    AI_COMPACT_ENABLED = os.environ.get('AI_COMPACT_ENABLED', 'true').lower() == 'true'
+    AI_COMPACT_SECTION_LINES = int(os.environ.get('AI_COMPACT_SECTION_LINES', 100))
+    AI_COMPACT_TOKEN_BUDGET = int(os.environ.get('AI_COMPACT_TOKEN_BUDGET', 24000))
+    # Cache of repeatable AI analyses (dry runs, script/output analysis); a TTL of 0 disables it
+    AI_CACHE_TTL_SECONDS = int(os.environ.get('AI_CACHE_TTL_SECONDS', 86400))
+    AI_CACHE_MEMORY_SIZE = int(os.environ.get('AI_CACHE_MEMORY_SIZE', 256))
+    AI_CACHE_MAX_ROWS = int(os.environ.get('AI_CACHE_MAX_ROWS', 5000))
+
     @staticmethod
     def get_app_config():
         """
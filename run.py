@@ -1,7 +1,13 @@
 # run.py
+from werkzeug.serving import is_running_from_reloader
 from app import create_app
+from app.scheduler.leader import scheduler_leader
 
 app = create_app()
 
 if __name__ == '__main__':
+    # Fire cron jobs from startup rather than from the first request (in the
+    # reloader's child, the process that actually serves requests)
+    if app.config.get('SCHEDULER_MODE') == 'embedded' and is_running_from_reloader():
+        scheduler_leader.start()
     app.run(host='0.0.0.0', port=5055, debug=True)
\ No newline at end of file